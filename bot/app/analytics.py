@@ -0,0 +1,137 @@
+"""
+Отчёты по выручке и подпискам на основе дневной сводки daily_stats.
+Сводка обновляется в тех же транзакциях, что и платежи, пробные периоды и рефералы,
+поэтому отчёт читает по строке на день и метрику, а не всю историю платежей.
+
+    python -m app.analytics --days 30 --daily
+    python -m app.analytics --backfill   # один раз после обновления: учесть старые оплаты
+"""
+import argparse
+import asyncio
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import AsyncIterator, Optional, Tuple
+
+from config import prices, YOOKASSA_MAX_WORKERS
+from app.database import iter_daily_stats
+
+# Метрики сводки без разбивки по тарифу
+USER_METRICS = {
+    'new_users': 'Новые пользователи',
+    'trials': 'Пробные периоды',
+    'referral_conversions': 'Покупки по рефералке',
+}
+
+
+@dataclass
+class DayStats:
+    day: str
+    revenue: Counter = field(default_factory=Counter)   # срок (мес.) -> выручка
+    payments: Counter = field(default_factory=Counter)  # срок (мес.) -> число оплат
+    counters: Counter = field(default_factory=Counter)  # метрика -> значение
+
+    def add(self, other: 'DayStats') -> None:
+        self.revenue.update(other.revenue)
+        self.payments.update(other.payments)
+        self.counters.update(other.counters)
+
+
+async def iter_days(day_from: date, day_to: date) -> AsyncIterator[DayStats]:
+    """Дни из сводки по порядку; строки одного дня собираются по мере чтения курсора."""
+    current: Optional[DayStats] = None
+    async for day, metric, key, value in iter_daily_stats(day_from.isoformat(), day_to.isoformat()):
+        if current is None or current.day != day:
+            if current is not None:
+                yield current
+            current = DayStats(day)
+        if metric == 'revenue':
+            current.revenue[key] += value
+        elif metric == 'payments':
+            current.payments[key] += value
+        else:
+            current.counters[metric] += value
+    if current is not None:
+        yield current
+
+
+def tariff_name(key: str) -> str:
+    if not key:
+        return 'Без тарифа'
+    period = int(key)
+    price = prices.get(period)
+    return f'{period} мес. ({price} ₽)' if price else f'{period} мес.'
+
+
+def format_day(stats: DayStats) -> str:
+    return (f"{stats.day}: {sum(stats.revenue.values())} ₽, оплат {sum(stats.payments.values())}, "
+            f"новых {stats.counters['new_users']}, пробных {stats.counters['trials']}, "
+            f"по рефералке {stats.counters['referral_conversions']}")
+
+
+def format_totals(total: DayStats, day_from: date, day_to: date) -> str:
+    lines = [f"📊 Статистика за {day_from:%d.%m.%Y} — {day_to:%d.%m.%Y}", '',
+             f"💰 Выручка: {sum(total.revenue.values())} ₽, оплат: {sum(total.payments.values())}"]
+    for key in sorted(total.payments, key=lambda k: int(k) if k else 0):
+        if total.payments[key]:
+            lines.append(f"  • {tariff_name(key)}: {total.payments[key]} шт., {total.revenue[key]} ₽")
+    lines.append('')
+    for metric, title in USER_METRICS.items():
+        lines.append(f"{title}: {total.counters[metric]}")
+    return '\n'.join(lines)
+
+
+async def build_report(days: int = 30, daily: bool = False, today: Optional[date] = None) -> str:
+    """Отчёт за последние days дней (включая сегодня); daily добавляет строку на каждый день."""
+    day_to = today or date.today()
+    day_from = day_to - timedelta(days=max(days, 1) - 1)
+    total = DayStats('total')
+    lines = []
+    async for stats in iter_days(day_from, day_to):
+        total.add(stats)
+        if daily:
+            lines.append(format_day(stats))
+    report = format_totals(total, day_from, day_to)
+    return report + ('\n\nПо дням:\n' + '\n'.join(lines) if lines else '')
+
+
+async def backfill_payments() -> Tuple[int, int]:
+    """
+    Перепроверяет в YooKassa старые платежи без статуса succeeded и учитывает оплаченные в сводке.
+    Нужна один раз после обновления: старые версии бота не отмечали оплаты в базе.
+    Возвращает (проверено, учтено). Запуск можно повторять — учтённые не проверяются снова.
+    """
+    from app.database import get_unconfirmed_payments, confirm_old_payments
+    from app.yoo_kassa import check_payment
+
+    pending = await get_unconfirmed_payments()
+    confirmed = 0
+    for start in range(0, len(pending), YOOKASSA_MAX_WORKERS):
+        batch = pending[start:start + YOOKASSA_MAX_WORKERS]
+        paid = await asyncio.gather(*(check_payment(payment_yoo_id) for payment_yoo_id in batch))
+        confirmed += await confirm_old_payments([payment_yoo_id for payment_yoo_id, ok in zip(batch, paid) if ok])
+    return len(pending), confirmed
+
+
+async def main() -> None:
+    from app.database import init_db, close_db
+
+    parser = argparse.ArgumentParser(description="Статистика выручки и подписок")
+    parser.add_argument("--days", type=int, default=30, help="за сколько последних дней")
+    parser.add_argument("--daily", action="store_true", help="печатать строку на каждый день")
+    parser.add_argument("--backfill", action="store_true",
+                        help="сначала перепроверить в YooKassa старые платежи и учесть оплаченные")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        if args.backfill:
+            checked, confirmed = await backfill_payments()
+            print(f"Проверено платежей: {checked}, учтено оплаченных: {confirmed}\n")
+        print(await build_report(args.days, args.daily))
+    finally:
+        await close_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
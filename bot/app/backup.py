@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from app.metrics import histogram, collected
+from config import DB_PATH, BACKUP_DIR, BACKUP_INTERVAL, BACKUP_KEEP, BACKUP_PAGES, BACKUP_SLEEP
+
+logger = logging.getLogger(__name__)
+
+FULL_SUFFIX = '.sqlite.gz'
+PAGES_SUFFIX = '.pages'
+INCREMENTAL_MAGIC = b'SQLITE-INCREMENTAL-1\n'
+DIGEST_SIZE = 8
+
+backup_latency = histogram('db_backup_seconds', 'Время создания резервной копии базы',
+                           buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0))
+_last_success: Dict[str, float] = {}
+collected('db_backup_last_success_timestamp', 'Время последней успешной резервной копии (unix)', 'kind',
+          lambda: dict(_last_success), type='gauge')
+
+# Полная копия и инкремент не выполняются одновременно
+_lock = asyncio.Lock()
+
+
+# --- Копирование --- #
+
+def _snapshot(source: Path, target: Path) -> None:
+    """
+    Согласованная копия работающей базы через online backup API SQLite.
+    Копируется по BACKUP_PAGES страниц за шаг с паузой BACKUP_SLEEP. Открытая читающая
+    транзакция фиксирует снимок WAL: бот между шагами свободно пишет в базу, а копирование
+    не начинается заново после каждой записи.
+    """
+    src = sqlite3.connect(source, timeout=5, isolation_level=None)
+    dst = sqlite3.connect(target)
+    try:
+        src.execute('BEGIN')
+        src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        # sleep в backup() действует только при занятой базе, поэтому паузу делаем сами
+        src.backup(dst, pages=BACKUP_PAGES, progress=lambda *_: time.sleep(BACKUP_SLEEP))
+        src.execute('COMMIT')
+    finally:
+        dst.close()
+        src.close()
+
+
+def _page_size(header: bytes) -> int:
+    """Размер страницы из заголовка файла базы (значение 1 означает 65536)."""
+    size = struct.unpack('>H', header[16:18])[0]
+    return 65536 if size == 1 else size
+
+
+def _file_page_size(path: Path) -> int:
+    with open(path, 'rb') as file:
+        return _page_size(file.read(100))
+
+
+def _iter_pages(path: Path, page_size: int) -> Iterator[bytes]:
+    with open(path, 'rb') as file:
+        for page in iter(lambda: file.read(page_size), b''):
+            yield page
+
+
+def _digest(page: bytes) -> bytes:
+    return hashlib.blake2b(page, digest_size=DIGEST_SIZE).digest()
+
+
+def _write_full(snapshot: Path, target: Path) -> None:
+    """Сжатая копия и рядом — хэши страниц, с которыми потом сравниваются инкременты."""
+    page_size = _file_page_size(snapshot)
+    digests = bytearray()
+    tmp = target.with_name(target.name + '.tmp')
+    with gzip.open(tmp, 'wb', compresslevel=6) as gz:
+        for page in _iter_pages(snapshot, page_size):
+            gz.write(page)
+            digests += _digest(page)
+    pages = _pages_path(target)
+    pages.with_name(pages.name + '.tmp').write_bytes(digests)
+    pages.with_name(pages.name + '.tmp').replace(pages)
+    tmp.replace(target)
+
+
+def _write_incremental(snapshot: Path, base: Path, target: Path) -> Optional[int]:
+    """
+    Инкремент: только страницы, изменившиеся с полной копии base.
+    Возвращает число страниц или None, если инкремент к этой копии сделать нельзя.
+    """
+    page_size = _file_page_size(snapshot)
+    with gzip.open(base, 'rb') as gz:
+        if page_size != _page_size(gz.read(100)):
+            return None
+    old = _pages_path(base).read_bytes()
+    page_count = snapshot.stat().st_size // page_size
+    changed = 0
+    tmp = target.with_name(target.name + '.tmp')
+    with gzip.open(tmp, 'wb', compresslevel=6) as gz:
+        gz.write(INCREMENTAL_MAGIC)
+        header = {'base': base.name, 'page_size': page_size, 'page_count': page_count}
+        gz.write(json.dumps(header).encode() + b'\n')
+        for number, page in enumerate(_iter_pages(snapshot, page_size)):
+            if old[number * DIGEST_SIZE:(number + 1) * DIGEST_SIZE] != _digest(page):
+                gz.write(struct.pack('>I', number) + page)
+                changed += 1
+    tmp.replace(target)
+    return changed
+
+
+# --- Файлы копий --- #
+
+def _pages_path(full: Path) -> Path:
+    return full.with_name(full.name[:-len(FULL_SUFFIX)] + PAGES_SUFFIX)
+
+
+def _stem(full: Path) -> str:
+    return full.name[:-len(FULL_SUFFIX)]
+
+
+def _list_full(directory: Path) -> List[Path]:
+    """Полные копии от старых к новым (в имени — время создания)."""
+    return sorted(directory.glob(f'{Path(DB_PATH).stem}-*{FULL_SUFFIX}'))
+
+
+def _list_incremental(full: Path) -> List[Path]:
+    return sorted(full.parent.glob(f'{_stem(full)}.inc-*.gz'))
+
+
+def _base_of(incremental: Path) -> Path:
+    return incremental.with_name(incremental.name.split('.inc-')[0] + FULL_SUFFIX)
+
+
+def _rotate(directory: Path) -> None:
+    """
+    Хранит BACKUP_KEEP последних полных копий. Инкременты нужны только к последней:
+    более ранние моменты покрывают сами полные копии.
+    """
+    fulls = _list_full(directory)
+    for index, full in enumerate(fulls):
+        if index < len(fulls) - 1:
+            for path in _list_incremental(full):
+                path.unlink(missing_ok=True)
+        if index < len(fulls) - max(BACKUP_KEEP, 1):
+            _pages_path(full).unlink(missing_ok=True)
+            full.unlink(missing_ok=True)
+
+
+def _run_backup(incremental: bool) -> Path:
+    directory = Path(BACKUP_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    snapshot = directory / f'.snapshot-{stamp}.tmp'
+    try:
+        _snapshot(Path(DB_PATH), snapshot)
+        fulls = _list_full(directory)
+        if incremental and fulls and _pages_path(fulls[-1]).exists():
+            target = directory / f'{_stem(fulls[-1])}.inc-{stamp}.gz'
+            changed = _write_incremental(snapshot, fulls[-1], target)
+            if changed is not None:
+                logger.info(f'Инкремент базы: {target.name}, изменено страниц: {changed}')
+                return target
+        # Нет полной копии, к которой можно сделать инкремент, — делаем полную
+        target = directory / f'{Path(DB_PATH).stem}-{stamp}{FULL_SUFFIX}'
+        _write_full(snapshot, target)
+        logger.info(f'Резервная копия базы: {target.name}, {target.stat().st_size // 1024} КБ')
+        return target
+    finally:
+        snapshot.unlink(missing_ok=True)
+        _rotate(directory)
+
+
+async def backup_database(incremental: bool = False) -> Path:
+    """
+    Резервная копия базы без остановки бота. Работа идёт в отдельном потоке и отдельном
+    соединении, поэтому обработчики не ждут копирования.
+    """
+    kind = 'incremental' if incremental else 'full'
+    async with _lock:
+        with backup_latency.track(kind=kind):
+            path = await asyncio.to_thread(_run_backup, incremental)
+    _last_success[kind] = time.time()
+    return path
+
+
+async def scheduled_backup() -> None:
+    """
+    Полная копия, если последняя старше BACKUP_INTERVAL часов.
+    Проверяется ежечасно, поэтому перезапуски бота не сбивают расписание и не плодят копий.
+    """
+    fulls = _list_full(Path(BACKUP_DIR)) if Path(BACKUP_DIR).exists() else []
+    if fulls and time.time() - fulls[-1].stat().st_mtime < BACKUP_INTERVAL * 3600 - 60:
+        return
+    await backup_database()
+
+
+async def scheduled_incremental() -> None:
+    await backup_database(incremental=True)
+
+
+# --- Восстановление и проверка --- #
+
+def restore(path: Path, target: Path) -> None:
+    """Восстанавливает базу из полной копии или из инкремента (вместе с его полной копией)."""
+    if target.exists():
+        raise FileExistsError(f'{target} уже существует')
+    base = _base_of(path) if '.inc-' in path.name else path
+    tmp = target.with_name(target.name + '.tmp')
+    with gzip.open(base, 'rb') as gz, open(tmp, 'wb') as out:
+        shutil.copyfileobj(gz, out)
+    if base != path:
+        with gzip.open(path, 'rb') as gz, open(tmp, 'r+b') as out:
+            if gz.readline() != INCREMENTAL_MAGIC:
+                raise ValueError(f'{path.name}: не инкремент базы')
+            header = json.loads(gz.readline())
+            if header['base'] != base.name:
+                raise ValueError(f'{path.name}: инкремент к другой копии ({header["base"]})')
+            page_size = header['page_size']
+            while True:
+                number = gz.read(4)
+                if not number:
+                    break
+                out.seek(struct.unpack('>I', number)[0] * page_size)
+                out.write(gz.read(page_size))
+            out.truncate(header['page_count'] * page_size)
+    tmp.replace(target)
+
+
+def verify(path: Path) -> str:
+    """Восстанавливает копию во временный файл и проверяет целостность базы."""
+    with tempfile.TemporaryDirectory() as directory:
+        target = Path(directory) / 'restored.sqlite'
+        restore(path, target)
+        conn = sqlite3.connect(target)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+            if result != 'ok':
+                raise ValueError(f'{path.name}: база повреждена: {result}')
+            counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                      for table in ('users', 'payments', 'referrals')}
+        finally:
+            conn.close()
+    return f'{path.name}: ok, ' + ', '.join(f'{table}: {count}' for table, count in counts.items())
+
+
+def _latest(directory: Path) -> Path:
+    fulls = _list_full(directory)
+    if not fulls:
+        raise FileNotFoundError(f'В {directory} нет резервных копий')
+    incrementals = _list_incremental(fulls[-1])
+    return incrementals[-1] if incrementals else fulls[-1]
+
+
+def main() -> None:
+    """
+    Резервные копии из консоли (бот при этом может работать):
+      python -m app.backup backup [--incremental]
+      python -m app.backup verify [ФАЙЛ]         — по умолчанию последняя копия
+      python -m app.backup restore ФАЙЛ КУДА
+    """
+    parser = argparse.ArgumentParser(description="Резервные копии базы")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backup = commands.add_parser("backup", help="сделать копию сейчас")
+    backup.add_argument("--incremental", action="store_true", help="только изменения с последней полной копии")
+    check = commands.add_parser("verify", help="восстановить во временный файл и проверить")
+    check.add_argument("path", nargs="?", type=Path)
+    restore_parser = commands.add_parser("restore", help="восстановить базу из копии")
+    restore_parser.add_argument("path", type=Path)
+    restore_parser.add_argument("target", type=Path)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    try:
+        if args.command == "backup":
+            print(asyncio.run(backup_database(args.incremental)))
+        elif args.command == "verify":
+            print(verify(args.path or _latest(Path(BACKUP_DIR))))
+        else:
+            restore(args.path, args.target)
+            print(f'Восстановлено в {args.target}')
+    except (OSError, ValueError, sqlite3.DatabaseError) as error:
+        print(f'Ошибка: {error}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
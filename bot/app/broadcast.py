@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError
+)
+
+from config import BROADCAST_RATE, BROADCAST_WORKERS
+from app.database import get_broadcast_done, save_broadcast_progress, mark_users_blocked
+from app.metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Сколько результатов копить перед записью контрольной точки
+CHECKPOINT_BATCH = 100
+# Повторов при сетевых ошибках и ошибках сервера Telegram
+MAX_ATTEMPTS = 3
+
+messages_sent = counter('broadcast_messages_total', 'Сообщения рассылок и напоминаний по результату')
+flood_waits = counter('broadcast_flood_waits_total', 'Ответы Telegram с требованием подождать (flood-wait)')
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты: rate токенов в секунду, не больше capacity подряд.
+    pause() останавливает выдачу токенов всем отправителям (flood-wait от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+@dataclass
+class BroadcastReport:
+    total: int = 0
+    skipped: int = 0  # уже обработаны до перезапуска
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    flood_waits: int = 0
+    elapsed: float = 0.0
+    errors: List[Tuple[str, str]] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        processed = self.sent + self.failed + self.blocked
+        rate = processed / self.elapsed if self.elapsed else 0.0
+        return (
+            f"Получателей: {self.total} (пропущено как уже обработанные: {self.skipped})\n"
+            f"✅ Отправлено: {self.sent}\n"
+            f"🚫 Заблокировали бота: {self.blocked}\n"
+            f"❌ Ошибки: {self.failed}\n"
+            f"⏳ Flood-wait: {self.flood_waits}\n"
+            f"⏱ {self.elapsed:.1f} с, {rate:.1f} сообщ./с"
+        )
+
+
+def broadcast_id_for(message: str) -> str:
+    """Идентификатор рассылки по тексту: повторный запуск того же текста продолжит её."""
+    return hashlib.sha1(message.encode()).hexdigest()[:12]
+
+
+async def _send(bot: Bot, limiter: TokenBucket, report: BroadcastReport, user_id: str, message: str) -> Tuple[str, Optional[str]]:
+    """Отправляет одно сообщение. Возвращает (статус, ошибка): sent, blocked или failed."""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        await limiter.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.HTML)
+            return 'sent', None
+        except TelegramRetryAfter as e:
+            # Лимит общий для бота, поэтому притормаживаем всех отправителей
+            report.flood_waits += 1
+            flood_waits.inc()
+            limiter.pause(e.retry_after)
+            logger.warning(f"Flood-wait {e.retry_after} с")
+        except TelegramForbiddenError as e:
+            return 'blocked', e.message
+        except TelegramBadRequest as e:
+            if 'chat not found' in e.message.lower():
+                return 'blocked', e.message
+            return 'failed', e.message
+        except (TelegramNetworkError, TelegramServerError) as e:
+            if attempt == MAX_ATTEMPTS:
+                return 'failed', e.message
+            await asyncio.sleep(2 ** attempt)
+    return 'failed', 'flood-wait'
+
+
+async def send_many(bot: Bot, messages: Iterable[Tuple[str, str]], report: BroadcastReport,
+                    on_batch: Callable[[List[Tuple[str, str, Optional[str]]]], Awaitable[None]],
+                    workers: int = BROADCAST_WORKERS, rate: float = BROADCAST_RATE,
+                    batch_size: int = CHECKPOINT_BATCH) -> None:
+    """
+    Отправляет сообщения (user_id, текст) пулом отправителей с общим ограничением частоты.
+    Результаты (user_id, статус, ошибка) передаются в on_batch пачками; заблокировавшие бота
+    пользователи помечаются в БД.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in messages:
+        queue.put_nowait(item)
+
+    limiter = TokenBucket(rate)
+    results: List[Tuple[str, str, Optional[str]]] = []
+
+    async def flush() -> None:
+        batch = results[:]
+        results.clear()
+        if batch:
+            await on_batch(batch)
+            await mark_users_blocked([user_id for user_id, status, _ in batch if status == 'blocked'])
+
+    async def worker() -> None:
+        while True:
+            try:
+                user_id, message = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status, error = await _send(bot, limiter, report, user_id, message)
+            messages_sent.inc(status=status)
+            setattr(report, status, getattr(report, status) + 1)
+            if error:
+                report.errors.append((user_id, error))
+            results.append((user_id, status, error))
+            if len(results) >= batch_size:
+                await flush()
+
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(worker()) for _ in range(max(1, workers))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # При ошибке одного отправителя остальные останавливаются до сохранения прогресса
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await flush()
+        report.elapsed += time.perf_counter() - start
+
+
+async def broadcast(bot: Bot, user_ids: Iterable[str], message: str, broadcast_id: Optional[str] = None,
+                    workers: int = BROADCAST_WORKERS, rate: float = BROADCAST_RATE) -> BroadcastReport:
+    """
+    Рассылает одно сообщение списку пользователей.
+    Прогресс сохраняется в таблицу broadcast_progress, поэтому прерванная рассылка
+    при повторном запуске продолжается с места остановки, а не доставленные из-за
+    временных ошибок сообщения отправляются повторно.
+    """
+    broadcast_id = broadcast_id or broadcast_id_for(message)
+    recipients = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    done = await get_broadcast_done(broadcast_id)
+
+    report = BroadcastReport(total=len(recipients))
+    pending = [user_id for user_id in recipients if user_id not in done]
+    report.skipped = len(recipients) - len(pending)
+
+    async def checkpoint(batch: List[Tuple[str, str, Optional[str]]]) -> None:
+        await save_broadcast_progress(broadcast_id, batch)
+
+    await send_many(bot, ((user_id, message) for user_id in pending), report, checkpoint, workers, rate)
+    logger.info(f"Рассылка {broadcast_id} завершена:\n{report}")
+    return report
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from app.database import kv_get, kv_set, kv_delete
+
+_MISSING = object()
+
+
+class MemoryBackend:
+    """Хранилище в памяти процесса: ограниченный LRU с временем жизни записей."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    async def get(self, key: Hashable) -> Tuple[bool, Any]:
+        item = self._data.get(key)
+        if item is None:
+            return False, None
+        value, expires_at = item
+        if time.monotonic() >= expires_at:
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    async def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+
+class SQLiteBackend:
+    """
+    Хранилище в таблице kv_cache общей базы: записи видны всем процессам бота,
+    поэтому запись в одном воркере сразу видна остальным. Значения хранятся в JSON,
+    decode восстанавливает из него исходный объект.
+    """
+
+    def __init__(self, namespace: str, decode: Callable[[Any], Any] = lambda value: value):
+        self.namespace = namespace
+        self.decode = decode
+
+    async def get(self, key: Hashable) -> Tuple[bool, Any]:
+        raw = await kv_get(f'{self.namespace}:{key}', time.time())
+        if raw is None:
+            return False, None
+        return True, self.decode(json.loads(raw))
+
+    async def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        await kv_set(f'{self.namespace}:{key}', json.dumps(value), time.time() + ttl)
+
+    async def delete(self, key: Hashable) -> None:
+        await kv_delete(f'{self.namespace}:{key}')
+
+
+class TTLCache:
+    """
+    Кэш с временем жизни записей поверх хранилища (в памяти или в SQLite).
+    get_or_load схлопывает параллельные промахи по одному ключу в один вызов загрузчика.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, backend: Optional[Any] = None):
+        self.ttl = ttl
+        self.backend = backend or MemoryBackend(maxsize)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    async def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value = await self.backend.get(key)
+        return value if found else default
+
+    async def set(self, key: Hashable, value: Any) -> None:
+        await self.backend.set(key, value, self.ttl)
+
+    async def invalidate(self, key: Hashable) -> None:
+        # Загрузка, начатая до записи, могла прочитать старые данные — её результат не сохраняем
+        self._inflight.pop(key, None)
+        await self.backend.delete(key)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                          remember: Callable[[Any], bool] = lambda value: True) -> Any:
+        """
+        Значение из кэша или результат loader. remember решает, сохранять ли результат:
+        например, отрицательный ответ можно отдать только тем, кто ждал его параллельно.
+        """
+        value = await self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.stats['hits'] += 1
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(inflight)
+
+        self.stats['misses'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+            if self._inflight.get(key) is future and remember(value):
+                await self.set(key, value)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим; не даём asyncio ругаться на неполученный результат
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+
+def make_cache(namespace: str, maxsize: int, ttl: float, backend: str,
+               decode: Callable[[Any], Any] = lambda value: value) -> TTLCache:
+    """Создаёт кэш с хранилищем, выбранным в конфиге (memory или sqlite)."""
+    if backend == 'sqlite':
+        return TTLCache(maxsize, ttl, SQLiteBackend(namespace, decode))
+    return TTLCache(maxsize, ttl, MemoryBackend(maxsize))
@@ -0,0 +1,35 @@
+from dataclasses import dataclass
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from app.database import Database, db
+from app.panel import PanelPool, panels
+from config import BOT_TOKEN, TELEGRAM_API_URL
+
+
+@dataclass
+class AppContext:
+    """
+    Общие ресурсы процесса: бот, панели Marzban с пулами соединений и база.
+    Создаётся один раз в точке входа (run.py, manual_notifications.py) и передаётся
+    обработчикам через workflow data диспетчера: async def handler(callback, ctx: AppContext).
+    """
+    bot: Bot
+    panels: PanelPool
+    db: Database
+
+    async def close(self) -> None:
+        await self.db.close()
+        await self.panels.close()
+        await self.bot.session.close()
+
+
+def create_bot() -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    return Bot(BOT_TOKEN, session=session)
+
+
+def create_context() -> AppContext:
+    return AppContext(bot=create_bot(), panels=panels, db=db)
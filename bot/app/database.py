@@ -1,19 +1,199 @@
+import asyncio
+import logging
 import aiosqlite
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Tuple, List, Union
+from typing import AsyncIterator, Dict, Optional, Set, Tuple, List, Union
+
+from config import DB_PATH as _DB_PATH, DB_READERS, prices, REFERRAL_BONUS_DAYS
+from app.metrics import histogram, timed
+
+DB_PATH = Path(_DB_PATH)
+
+# Настройки, применяемые к каждому соединению
+PRAGMAS = (
+    'PRAGMA synchronous = NORMAL;'
+    'PRAGMA cache_size = -16000;'    # ~16 МБ страничного кэша
+    'PRAGMA mmap_size = 134217728;'  # 128 МБ memory-mapped I/O
+    'PRAGMA temp_store = MEMORY;'
+    'PRAGMA busy_timeout = 5000;'
+)
+# Размер кэша подготовленных выражений sqlite3 на соединение
+CACHED_STATEMENTS = 256
+
+db_latency = histogram('db_query_seconds', 'Время выполнения запросов к базе по функциям')
+db_wait = histogram('db_connection_wait_seconds', 'Ожидание свободного соединения с базой',
+                    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+# Версионированные миграции схемы: (версия, список выражений).
+# Каждая миграция применяется в отдельной короткой транзакции, номера только растут.
+MIGRATIONS: List[Tuple[int, Tuple[str, ...]]] = [
+    (1, ('CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments (user_id)',)),
+    (2, ('CREATE INDEX IF NOT EXISTS idx_payments_yoo_id ON payments (payment_yoo_id)',)),
+    (3, ('CREATE INDEX IF NOT EXISTS idx_users_expire ON users (expire)',)),
+    (4, ('ALTER TABLE users ADD COLUMN blocked BOOLEAN DEFAULT 0',
+         '''CREATE TABLE IF NOT EXISTS broadcast_progress (
+                broadcast_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (broadcast_id, user_id)
+            ) WITHOUT ROWID''')),
+    (5, ('''CREATE TABLE IF NOT EXISTS panel_users (
+                username TEXT PRIMARY KEY,
+                expire INTEGER,
+                used_traffic INTEGER,
+                status TEXT,
+                subscription_url TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''',
+         'CREATE INDEX IF NOT EXISTS idx_panel_users_expire ON panel_users (expire)',
+         'CREATE INDEX IF NOT EXISTS idx_panel_users_unused ON panel_users (expire) WHERE used_traffic = 0')),
+    (6, ('''CREATE TABLE IF NOT EXISTS reminder_log (
+                user_id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                expire INTEGER NOT NULL,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, stage, expire)
+            ) WITHOUT ROWID''',)),
+    (7, ('''CREATE TABLE IF NOT EXISTS kv_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID''',
+         'CREATE INDEX IF NOT EXISTS idx_kv_cache_expires ON kv_cache (expires_at)',
+         '''CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID''')),
+    (8, ('ALTER TABLE payments ADD COLUMN period INTEGER',
+         # Срок старых платежей восстанавливается по сумме из тарифов
+         'UPDATE payments SET period = CASE amount '
+         + ' '.join(f'WHEN {price} THEN {period}' for period, price in prices.items()) + ' END',
+         '''CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                key TEXT NOT NULL DEFAULT '',
+                value INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, metric, key)
+            ) WITHOUT ROWID''',
+         # Старые версии бота не записывали статус succeeded (аргументы update_payment_status
+         # были перепутаны), поэтому их оплаты здесь не видны: они учитываются после
+         # перепроверки в YooKassa — python -m app.analytics --backfill
+         '''INSERT INTO daily_stats (day, metric, key, value)
+            SELECT date(date), 'revenue', COALESCE(CAST(period AS TEXT), ''), SUM(amount)
+            FROM payments WHERE status = 'succeeded' GROUP BY 1, 3''',
+         '''INSERT INTO daily_stats (day, metric, key, value)
+            SELECT date(date), 'payments', COALESCE(CAST(period AS TEXT), ''), COUNT(*)
+            FROM payments WHERE status = 'succeeded' GROUP BY 1, 3''')),
+    (9, ('''CREATE TABLE IF NOT EXISTS user_panels (
+                user_id TEXT PRIMARY KEY,
+                panel TEXT NOT NULL
+            ) WITHOUT ROWID''',
+         'CREATE INDEX IF NOT EXISTS idx_user_panels_panel ON user_panels (panel)')),
+    (10, ('CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_user_id)',
+          '''CREATE TABLE IF NOT EXISTS referral_stats (
+                referrer_user_id TEXT PRIMARY KEY,
+                invited INTEGER NOT NULL DEFAULT 0,
+                converted INTEGER NOT NULL DEFAULT 0,
+                bonus_days INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID''',
+          f'''INSERT INTO referral_stats (referrer_user_id, invited, converted, bonus_days)
+             SELECT referrer_user_id, COUNT(*), SUM(used = 1), SUM(used = 1) * {REFERRAL_BONUS_DAYS}
+             FROM referrals GROUP BY referrer_user_id''')),
+    (11, ('''CREATE TABLE IF NOT EXISTS qr_files (
+                url_hash TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) WITHOUT ROWID''',)),
+]
+
+
+class Database:
+    """
+    Долгоживущие соединения с SQLite в режиме WAL:
+    одно соединение на запись (под блокировкой) и небольшой пул соединений на чтение.
+    Читатели не блокируются писателем, а подготовленные выражения переиспользуются.
+    """
+
+    def __init__(self, path: Path, readers: int = DB_READERS):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._pool: Optional[asyncio.Queue] = None
+        self._connections: List[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=CACHED_STATEMENTS)
+        # executescript не оставляет открытых курсоров, которые держали бы блокировку
+        await conn.executescript(PRAGMAS)
+        self._connections.append(conn)
+        return conn
+
+    async def open(self) -> None:
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        await self._writer.executescript('PRAGMA journal_mode = WAL;')
+        self._pool = asyncio.Queue()
+        for _ in range(self.readers):
+            conn = await self._connect()
+            await conn.executescript('PRAGMA query_only = ON;')
+            self._pool.put_nowait(conn)
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+        # Переносим WAL в основной файл, чтобы не оставлять большой журнал
+        await self._writer.executescript('PRAGMA optimize; PRAGMA wal_checkpoint(TRUNCATE);')
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+        self._writer = None
+        self._pool = None
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Выдаёт свободное соединение на чтение из пула."""
+        with db_wait.time(mode='read'):
+            conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Выдаёт соединение на запись; при выходе фиксирует транзакцию или откатывает её при ошибке."""
+        with db_wait.time(mode='write'):
+            await self._write_lock.acquire()
+        try:
+            yield self._writer
+            await self._writer.commit()
+        except BaseException:
+            await self._writer.rollback()
+            raise
+        finally:
+            self._write_lock.release()
+
+
+db = Database(DB_PATH)
 
-DB_PATH = Path("/bot/database/subscriptions.sqlite")
 
 async def init_db() -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''CREATE TABLE IF NOT EXISTS users (
+    await db.open()
+    async with db.write() as conn:
+        await conn.execute('''CREATE TABLE IF NOT EXISTS users (
                                 user_id TEXT PRIMARY KEY,
                                 username TEXT,
                                 expire INTEGER,
                                 trial BOOLEAN DEFAULT 0
                              )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS payments (
+        await conn.execute('''CREATE TABLE IF NOT EXISTS payments (
                                 payment_id TEXT PRIMARY KEY,
                                 user_id TEXT,
                                 amount INTEGER,
@@ -21,148 +201,681 @@ async def init_db() -> None:
                                 status TEXT,
                                 payment_yoo_id TEXT
                              )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS referrals (
+        await conn.execute('''CREATE TABLE IF NOT EXISTS referrals (
                                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                                 referrer_user_id TEXT NOT NULL,
                                 referral_user_id TEXT UNIQUE NOT NULL,
                                 used BOOLEAN DEFAULT FALSE,
                                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                              )''')
-        await db.commit()
+        await conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+                                version INTEGER PRIMARY KEY,
+                                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                             )''')
+    await apply_migrations()
 
 
+async def apply_migrations() -> None:
+    """
+    Применяет недостающие миграции из MIGRATIONS.
+    Блокировка записи отпускается между миграциями, а читатели в режиме WAL
+    не ждут построения индексов, поэтому даже на большой базе бот не замирает надолго.
+    """
+    async with db.read() as conn:
+        async with conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version') as cursor:
+            current = (await cursor.fetchone())[0]
+
+    applied = False
+    for version, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        async with db.write() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            # Миграцию мог успеть применить другой процесс бота
+            async with conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)) as cursor:
+                if await cursor.fetchone():
+                    continue
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+        applied = True
+        logging.info(f"Применена миграция схемы БД №{version}")
+
+    if applied:
+        # Обновляем статистику планировщика запросов для новых индексов
+        async with db.write() as conn:
+            await conn.executescript('PRAGMA analysis_limit = 400; PRAGMA optimize;')
+
+
+async def close_db() -> None:
+    await db.close()
+
+
+async def _bump_stat(conn: aiosqlite.Connection, metric: str, value: int = 1, key: str = '',
+                     day: Optional[str] = None) -> None:
+    """Увеличивает счётчик дневной сводки daily_stats за day, по умолчанию за сегодня (в транзакции вызывающего)."""
+    await conn.execute('''
+        INSERT INTO daily_stats (day, metric, key, value) VALUES (COALESCE(?, date('now', 'localtime')), ?, ?, ?)
+        ON CONFLICT(day, metric, key) DO UPDATE SET value = value + excluded.value
+    ''', (day, metric, key, value))
+
+
+@timed(db_latency)
 async def add_user_to_db(user_id: str, username: str, expire: int, trial: bool) -> None:
     """
     Добавляет пользователя в базу данных или обновляет его данные, если он уже существует.
+    Первая активация подписки учитывается в дневной сводке как новый пользователь.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''
-            INSERT INTO users (user_id, username, expire, trial) 
-            VALUES (?, ?, ?, ?) 
-            ON CONFLICT(user_id) DO UPDATE 
+    async with db.write() as conn:
+        async with conn.execute('SELECT expire FROM users WHERE user_id = ?', (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        if expire is not None and (row is None or row[0] is None):
+            await _bump_stat(conn, 'new_users')
+        await conn.execute('''
+            INSERT INTO users (user_id, username, expire, trial)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE
             SET username = excluded.username,
                 expire = excluded.expire,
-                trial = excluded.trial
+                trial = users.trial OR excluded.trial
         ''', (user_id, username, expire, trial))
-        await db.commit()
 
 
-async def user_use_trial_to_db(user_id: str) -> None:
+@timed(db_latency)
+async def claim_trial(user_id: str) -> bool:
     """
-    Устанавливает флаг trial для пользователя в базе данных.
+    Атомарно отмечает пробный период использованным.
+    Возвращает True только для первого вызова: повторные нажатия и параллельные
+    запросы получают False и пробный период не активируют.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('UPDATE users SET trial = 1 WHERE user_id = ?', (user_id,))
-        await db.commit()
+    async with db.write() as conn:
+        async with conn.execute('''
+            INSERT INTO users (user_id, trial) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET trial = 1 WHERE users.trial IS NOT 1
+            RETURNING user_id
+        ''', (user_id,)) as cursor:
+            claimed = await cursor.fetchone() is not None
+        if claimed:
+            await _bump_stat(conn, 'trials')
+        return claimed
 
 
+@timed(db_latency)
+async def release_trial(user_id: str) -> None:
+    """
+    Снимает отметку о пробном периоде, если активировать его не удалось.
+    """
+    async with db.write() as conn:
+        async with conn.execute('UPDATE users SET trial = 0 WHERE user_id = ? AND trial = 1 RETURNING 1',
+                                (user_id,)) as cursor:
+            released = await cursor.fetchone() is not None
+        if released:
+            await _bump_stat(conn, 'trials', -1)
+
+
+@timed(db_latency)
 async def check_user_trial(user_id: str) -> bool:
     """
     Проверяет, использовал ли пользователь пробный период.
     Возвращает True, если пробный период использован, иначе False.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute('SELECT trial FROM users WHERE user_id = ?', (user_id,))
-        trial = await cursor.fetchone()
-        return bool(trial and trial[0] == 1)
+    async with db.read() as conn:
+        async with conn.execute('SELECT trial FROM users WHERE user_id = ?', (user_id,)) as cursor:
+            trial = await cursor.fetchone()
+            return bool(trial and trial[0] == 1)
 
 
-async def add_payment_to_db(payment_id: str, user_id: str, amount: int, status: str, payment_yoo_id: str) -> None:
+@timed(db_latency)
+async def add_payment_to_db(payment_id: str, user_id: str, amount: int, status: str, payment_yoo_id: str,
+                            period: Optional[int] = None) -> None:
     """
     Добавляет информацию о платеже в базу данных.
     """
     now = datetime.now().isoformat(sep=' ', timespec='seconds')
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''
-            INSERT INTO payments (payment_id, user_id, amount, date, status, payment_yoo_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (payment_id, user_id, amount, now, status, payment_yoo_id))
-        await db.commit()
+    async with db.write() as conn:
+        await conn.execute('''
+            INSERT INTO payments (payment_id, user_id, amount, date, status, payment_yoo_id, period)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (payment_id, user_id, amount, now, status, payment_yoo_id, period))
 
 
+@timed(db_latency)
 async def update_payment_status(payment_yoo_id: str, status: str) -> None:
     """
     Обновляет статус платежа в базе данных.
+    Если платёж перестаёт или начинает считаться успешным, дневная сводка корректируется.
+    """
+    async with db.write() as conn:
+        async with conn.execute('SELECT status, amount, period FROM payments WHERE payment_yoo_id = ?',
+                                (payment_yoo_id,)) as cursor:
+            row = await cursor.fetchone()
+        await conn.execute('UPDATE payments SET status = ? WHERE payment_yoo_id = ?', (status, payment_yoo_id))
+        if row and (row[0] == 'succeeded') != (status == 'succeeded'):
+            await _bump_payment_stats(conn, row[1], row[2], 1 if status == 'succeeded' else -1)
+
+
+@timed(db_latency)
+async def get_payment(payment_yoo_id: str) -> Optional[Tuple[str, int, Optional[int], str]]:
+    """
+    Платёж по id YooKassa: (user_id, amount, period, status) или None.
+    """
+    async with db.read() as conn:
+        async with conn.execute('SELECT user_id, amount, period, status FROM payments WHERE payment_yoo_id = ?',
+                                (payment_yoo_id,)) as cursor:
+            row = await cursor.fetchone()
+            return tuple(row) if row else None
+
+
+@timed(db_latency)
+async def claim_payment(payment_yoo_id: str) -> Optional[Tuple[str, Optional[int]]]:
+    """
+    Атомарно переводит платёж в статус succeeded.
+    Возвращает (user_id, срок из записи платежа), только если переход выполнил именно этот вызов,
+    иначе None — так подписка активируется ровно один раз, даже если платёж подтверждают и кнопка, и вебхук.
+    """
+    async with db.write() as conn:
+        async with conn.execute('''
+            UPDATE payments SET status = 'succeeded'
+            WHERE payment_yoo_id = ? AND status IS NOT 'succeeded'
+            RETURNING user_id, amount, period
+        ''', (payment_yoo_id,)) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        await _bump_payment_stats(conn, row[1], row[2])
+        return row[0], row[2]
+
+
+async def _bump_payment_stats(conn: aiosqlite.Connection, amount: int, period: Optional[int], sign: int = 1,
+                              day: Optional[str] = None) -> None:
+    key = str(period) if period is not None else ''
+    await _bump_stat(conn, 'revenue', sign * (amount or 0), key, day)
+    await _bump_stat(conn, 'payments', sign, key, day)
+
+
+@timed(db_latency)
+async def get_unconfirmed_payments() -> List[str]:
+    """
+    id YooKassa платежей, созданных до миграции 8 и не отмеченных как succeeded.
+    Более новые платежи бот отмечает сам, их подтверждение остаётся за кнопкой и вебхуком.
+    """
+    async with db.read() as conn:
+        async with conn.execute('''
+            SELECT payment_yoo_id FROM payments
+            WHERE status IS NOT 'succeeded' AND payment_yoo_id IS NOT NULL
+              AND date < (SELECT datetime(applied_at, 'localtime') FROM schema_version WHERE version = 8)
+            ORDER BY date
+        ''') as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+@timed(db_latency)
+async def confirm_old_payments(payment_yoo_ids: List[str]) -> int:
+    """
+    Отмечает оплаченными старые платежи, подписку по которым уже выдали, и учитывает их
+    в дневной сводке за день платежа. Возвращает число отмеченных.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('UPDATE payments SET status = ? WHERE payment_yoo_id = ?', (status, payment_yoo_id))
-        await db.commit()
+    confirmed = 0
+    async with db.write() as conn:
+        for payment_yoo_id in payment_yoo_ids:
+            async with conn.execute('''
+                UPDATE payments SET status = 'succeeded'
+                WHERE payment_yoo_id = ? AND status IS NOT 'succeeded'
+                RETURNING date(date), amount, period
+            ''', (payment_yoo_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                await _bump_payment_stats(conn, row[1], row[2], day=row[0])
+                confirmed += 1
+    return confirmed
 
 
+@timed(db_latency)
 async def get_payments_from_db(user_id: str) -> List[aiosqlite.Row]:
     """
     Получает все платежи пользователя из базы данных.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT * FROM payments WHERE user_id = ?', (user_id,)) as cursor:
+    async with db.read() as conn:
+        async with conn.execute('SELECT * FROM payments WHERE user_id = ?', (user_id,)) as cursor:
             return await cursor.fetchall()
 
 
+@timed(db_latency)
 async def get_all_payments_from_db() -> List[aiosqlite.Row]:
     """
     Получает все платежи из базы данных.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT * FROM payments') as cursor:
+    async with db.read() as conn:
+        async with conn.execute('SELECT * FROM payments') as cursor:
             return await cursor.fetchall()
 
 
+@timed(db_latency)
 async def get_user_from_db(user_id: str) -> Optional[aiosqlite.Row]:
     """
     Получает информацию о пользователе из базы данных по user_id.
     Возвращает строку с данными пользователя или None, если пользователь не найден.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
+    async with db.read() as conn:
+        async with conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
             return await cursor.fetchone()
 
 
-async def get_all_users() -> List[str]:
+@timed(db_latency)
+async def get_all_users(exclude_blocked: bool = False) -> List[str]:
     """
     Получает список всех пользователей из базы данных.
-    Возвращает список user_id всех пользователей.
+    Возвращает список user_id всех пользователей (exclude_blocked — без заблокировавших бота).
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT user_id FROM users') as cursor:
+    query = 'SELECT user_id FROM users WHERE blocked = 0' if exclude_blocked else 'SELECT user_id FROM users'
+    async with db.read() as conn:
+        async with conn.execute(query) as cursor:
             rows = await cursor.fetchall()
             return [row[0] for row in rows]
 
 
+@timed(db_latency)
 async def verify_referral(referral_user_id: str, use: bool = False) -> Union[bool, Tuple[bool, Optional[int]]]:
     """
     Проверяет, существует ли запись о реферале в базе данных.
     use параметр определяет используется ли бонус реферала.
-    Если use=True, то помечает бонус как использованный и возвращает user_id реферера.
+    Если use=True, то атомарно помечает бонус как использованный и возвращает user_id реферера
+    (параллельные активации получают бонус только один раз).
     Если use=False, то просто проверяет был ли юзер рефералом и возвращает True/False.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT referrer_user_id, used FROM referrals WHERE referral_user_id = ?', (referral_user_id,)) as cursor:
-            result = await cursor.fetchone()
-            if use:
-                if not result:
-                    return False, None
-                referrer_user_id, used = result
-                if used != 1:
-                    await db.execute('UPDATE referrals SET used = 1 WHERE referral_user_id = ?', (referral_user_id,))
-                    await db.commit()
-                    return True, referrer_user_id
-                return False, None
-            else:
-                return bool(result)
+    if not use:
+        async with db.read() as conn:
+            async with conn.execute('SELECT 1 FROM referrals WHERE referral_user_id = ?', (referral_user_id,)) as cursor:
+                return bool(await cursor.fetchone())
 
+    async with db.write() as conn:
+        async with conn.execute(
+            'UPDATE referrals SET used = 1 WHERE referral_user_id = ? AND used IS NOT 1 RETURNING referrer_user_id',
+            (referral_user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return False, None
+        await _bump_referral_stats(conn, row[0], converted=1)
+        await _bump_stat(conn, 'referral_conversions')
+        return True, row[0]
 
-async def add_referral_to_db(referrer_user_id: str, referral_user_id: str) -> None:
+
+@timed(db_latency)
+async def release_referral(referral_user_id: str) -> None:
     """
-    Добавляет запись о реферале в базу данных.
-    Если запись уже существует, то ничего не делает.
+    Возвращает неиспользованным бонус реферала, если активация подписки не удалась.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        try:
-            await db.execute(
-                'INSERT INTO referrals (referrer_user_id, referral_user_id) VALUES (?, ?)',
-                (referrer_user_id, referral_user_id)
+    async with db.write() as conn:
+        async with conn.execute(
+            'UPDATE referrals SET used = 0 WHERE referral_user_id = ? AND used = 1 RETURNING referrer_user_id',
+            (referral_user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            await _bump_referral_stats(conn, row[0], converted=-1)
+            await _bump_stat(conn, 'referral_conversions', -1)
+
+
+async def _bump_referral_stats(conn: aiosqlite.Connection, referrer_user_id: str,
+                               invited: int = 0, converted: int = 0) -> None:
+    """Обновляет счётчики реферера в referral_stats (в транзакции вызывающего)."""
+    await conn.execute('''
+        INSERT INTO referral_stats (referrer_user_id, invited, converted, bonus_days) VALUES (?, ?, ?, ?)
+        ON CONFLICT(referrer_user_id) DO UPDATE
+        SET invited = invited + excluded.invited,
+            converted = converted + excluded.converted,
+            bonus_days = bonus_days + excluded.bonus_days
+    ''', (referrer_user_id, invited, converted, converted * REFERRAL_BONUS_DAYS))
+
+
+@timed(db_latency)
+async def get_referral_stats(referrer_user_id: str) -> Tuple[int, int, int]:
+    """
+    Счётчики реферера: (приглашено, купили подписку, получено бонусных дней).
+    """
+    async with db.read() as conn:
+        async with conn.execute(
+            'SELECT invited, converted, bonus_days FROM referral_stats WHERE referrer_user_id = ?', (referrer_user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            return tuple(row) if row else (0, 0, 0)
+
+
+@timed(db_latency)
+async def add_referral_to_db(referrer_user_id: str, referral_user_id: str) -> bool:
+    """
+    Добавляет запись о реферале в базу данных, если пользователь ещё не пользовался ботом
+    и не был приглашён раньше. Возвращает True, если запись добавлена.
+    """
+    async with db.write() as conn:
+        async with conn.execute('''
+            INSERT OR IGNORE INTO referrals (referrer_user_id, referral_user_id)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM users WHERE user_id = ?)
+            RETURNING 1
+        ''', (referrer_user_id, referral_user_id, referral_user_id)) as cursor:
+            added = await cursor.fetchone() is not None
+        if added:
+            await _bump_referral_stats(conn, referrer_user_id, invited=1)
+        return added
+
+
+@timed(db_latency)
+async def mark_users_blocked(user_ids: List[str]) -> None:
+    """
+    Помечает пользователей, заблокировавших бота, чтобы не слать им рассылки.
+    """
+    if not user_ids:
+        return
+    async with db.write() as conn:
+        await conn.executemany('UPDATE users SET blocked = 1 WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+
+
+@timed(db_latency)
+async def unblock_user(user_id: str) -> None:
+    """
+    Снимает отметку о блокировке, когда пользователь снова пишет боту.
+    """
+    async with db.write() as conn:
+        await conn.execute('UPDATE users SET blocked = 0 WHERE user_id = ? AND blocked = 1', (user_id,))
+
+
+@timed(db_latency)
+async def get_broadcast_done(broadcast_id: str) -> Set[str]:
+    """
+    Возвращает user_id, которым рассылка уже доставлена или которые заблокировали бота.
+    Пользователи со статусом failed (сеть, flood-wait) при повторном запуске получают сообщение снова.
+    """
+    async with db.read() as conn:
+        async with conn.execute(
+            "SELECT user_id FROM broadcast_progress WHERE broadcast_id = ? AND status IN ('sent', 'blocked')",
+            (broadcast_id,)
+        ) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+
+@timed(db_latency)
+async def save_broadcast_progress(broadcast_id: str, results: List[Tuple[str, str, Optional[str]]]) -> None:
+    """
+    Сохраняет контрольную точку рассылки: список (user_id, статус, ошибка).
+    """
+    if not results:
+        return
+    async with db.write() as conn:
+        await conn.executemany('''
+            INSERT INTO broadcast_progress (broadcast_id, user_id, status, error)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(broadcast_id, user_id) DO UPDATE
+            SET status = excluded.status, error = excluded.error, updated_at = CURRENT_TIMESTAMP
+        ''', [(broadcast_id, user_id, status, error) for user_id, status, error in results])
+
+
+@timed(db_latency)
+async def upsert_panel_users(rows: List[Tuple[str, Optional[int], Optional[int], str, Optional[str]]]) -> int:
+    """
+    Записывает в зеркало panel_users строки (username, expire, used_traffic, status, subscription_url).
+    Неизменившиеся строки не перезаписываются. Возвращает число добавленных или обновлённых строк.
+    """
+    if not rows:
+        return 0
+    async with db.write() as conn:
+        before = conn.total_changes
+        await conn.executemany('''
+            INSERT INTO panel_users (username, expire, used_traffic, status, subscription_url)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(username) DO UPDATE
+            SET expire = excluded.expire,
+                used_traffic = excluded.used_traffic,
+                status = excluded.status,
+                subscription_url = excluded.subscription_url,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE panel_users.expire IS NOT excluded.expire
+               OR panel_users.used_traffic IS NOT excluded.used_traffic
+               OR panel_users.status IS NOT excluded.status
+               OR panel_users.subscription_url IS NOT excluded.subscription_url
+        ''', rows)
+        return conn.total_changes - before
+
+
+@timed(db_latency)
+async def prune_panel_users(seen: Set[str]) -> int:
+    """
+    Удаляет из зеркала пользователей, которых больше нет в панели.
+    Возвращает число удалённых строк.
+    """
+    async with db.write() as conn:
+        await conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen_panel_users (username TEXT PRIMARY KEY)')
+        await conn.execute('DELETE FROM seen_panel_users')
+        await conn.executemany('INSERT OR IGNORE INTO seen_panel_users (username) VALUES (?)', [(u,) for u in seen])
+        cursor = await conn.execute(
+            'DELETE FROM panel_users WHERE username NOT IN (SELECT username FROM seen_panel_users)'
+        )
+        await conn.execute('DELETE FROM seen_panel_users')
+        return cursor.rowcount
+
+
+@timed(db_latency)
+async def get_user_panel(user_id: str) -> Optional[str]:
+    """
+    Панель Marzban, на которой заведён пользователь, или None, если она ещё не известна.
+    """
+    async with db.read() as conn:
+        async with conn.execute('SELECT panel FROM user_panels WHERE user_id = ?', (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+
+@timed(db_latency)
+async def set_user_panels(rows: List[Tuple[str, str]]) -> int:
+    """
+    Записывает привязку пользователей к панелям: строки (user_id, panel).
+    Неизменившиеся строки не перезаписываются. Возвращает число добавленных или обновлённых строк.
+    """
+    if not rows:
+        return 0
+    async with db.write() as conn:
+        before = conn.total_changes
+        await conn.executemany('''
+            INSERT INTO user_panels (user_id, panel) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET panel = excluded.panel
+            WHERE user_panels.panel IS NOT excluded.panel
+        ''', rows)
+        return conn.total_changes - before
+
+
+@timed(db_latency)
+async def count_users_by_panel() -> Dict[str, int]:
+    """
+    Число пользователей на каждой панели (по индексу idx_user_panels_panel).
+    """
+    async with db.read() as conn:
+        async with conn.execute('SELECT panel, COUNT(*) FROM user_panels GROUP BY panel') as cursor:
+            return {panel: count for panel, count in await cursor.fetchall()}
+
+
+@timed(db_latency)
+async def get_users_page(after: str, limit: int) -> List[Tuple[str, Optional[str], object]]:
+    """
+    Страница пользователей (user_id, username, expire) по возрастанию user_id, начиная после after.
+    Постраничная выборка по ключу: каждая страница — поиск по первичному ключу, без OFFSET.
+    """
+    async with db.read() as conn:
+        async with conn.execute(
+            'SELECT user_id, username, expire FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after, limit)
+        ) as cursor:
+            return [tuple(row) for row in await cursor.fetchall()]
+
+
+@timed(db_latency)
+async def repair_users_expire(rows: List[Tuple[str, Optional[str], Optional[int], object]]) -> int:
+    """
+    Исправляет сроки подписки одной транзакцией: строки (user_id, username, expire, прежний expire).
+    Строка меняется, только если срок в базе всё ещё равен прежнему — параллельная активация
+    не перезаписывается. Отсутствующие пользователи добавляются. Возвращает число изменённых строк.
+    """
+    async with db.write() as conn:
+        before = conn.total_changes
+        await conn.executemany('''
+            INSERT INTO users (user_id, username, expire) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET expire = excluded.expire WHERE users.expire IS ?
+        ''', rows)
+        return conn.total_changes - before
+
+
+@timed(db_latency)
+async def get_inactive_panel_users(now: int) -> List[str]:
+    """
+    Пользователи бота с активной подпиской, которые ещё не использовали трафик (по зеркалу panel_users).
+    """
+    async with db.read() as conn:
+        async with conn.execute('''
+            SELECT p.username FROM panel_users p
+            JOIN users u ON u.user_id = p.username
+            WHERE p.used_traffic = 0 AND p.expire > ? AND u.blocked = 0
+        ''', (now,)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+@timed(db_latency)
+async def get_due_reminders(stage: str, expire_from: int, expire_to: int) -> List[Tuple[str, int]]:
+    """
+    Пользователи бота, у которых срок подписки в (expire_from, expire_to] и которым
+    напоминание этапа stage для этого срока ещё не отправлялось. Возвращает (user_id, expire).
+    """
+    async with db.read() as conn:
+        async with conn.execute('''
+            SELECT p.username, p.expire FROM panel_users p
+            JOIN users u ON u.user_id = p.username
+            WHERE p.expire > ? AND p.expire <= ? AND u.blocked = 0
+              AND NOT EXISTS (
+                  SELECT 1 FROM reminder_log r
+                  WHERE r.user_id = p.username AND r.stage = ? AND r.expire = p.expire
+              )
+        ''', (expire_from, expire_to, stage)) as cursor:
+            return await cursor.fetchall()
+
+
+@timed(db_latency)
+async def claim_reminders(stage: str, due: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    """
+    Записывает напоминания в журнал до отправки и возвращает только те, что записал этот вызов.
+    Повторный или параллельный запуск не отправит одно напоминание дважды.
+    """
+    claimed = []
+    async with db.write() as conn:
+        for user_id, expire in due:
+            cursor = await conn.execute(
+                'INSERT OR IGNORE INTO reminder_log (user_id, stage, expire) VALUES (?, ?, ?)',
+                (user_id, stage, expire)
             )
-            await db.commit()
-        except aiosqlite.IntegrityError:
-            # Игнорируем, если запись уже существует
-            pass
+            if cursor.rowcount == 1:
+                claimed.append((user_id, expire))
+    return claimed
+
+
+@timed(db_latency)
+async def release_reminders(stage: str, released: List[Tuple[str, int]]) -> None:
+    """
+    Удаляет записи журнала для неотправленных напоминаний, чтобы повторить их при следующем запуске.
+    """
+    if not released:
+        return
+    async with db.write() as conn:
+        await conn.executemany(
+            'DELETE FROM reminder_log WHERE user_id = ? AND stage = ? AND expire = ?',
+            [(user_id, stage, expire) for user_id, expire in released]
+        )
+
+
+@timed(db_latency)
+async def get_qr_file_id(url_hash: str) -> Optional[str]:
+    """
+    file_id уже загруженного в Telegram QR-кода ссылки или None.
+    """
+    async with db.read() as conn:
+        async with conn.execute('SELECT file_id FROM qr_files WHERE url_hash = ?', (url_hash,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+
+@timed(db_latency)
+async def set_qr_file_id(url_hash: str, file_id: str) -> None:
+    async with db.write() as conn:
+        await conn.execute('INSERT OR REPLACE INTO qr_files (url_hash, file_id) VALUES (?, ?)', (url_hash, file_id))
+
+
+@timed(db_latency)
+async def delete_qr_file_id(url_hash: str) -> None:
+    async with db.write() as conn:
+        await conn.execute('DELETE FROM qr_files WHERE url_hash = ?', (url_hash,))
+
+
+@timed(db_latency)
+async def kv_get(key: str, now: float) -> Optional[str]:
+    """
+    Значение общего кэша kv_cache или None, если записи нет или она устарела.
+    """
+    async with db.read() as conn:
+        async with conn.execute('SELECT value FROM kv_cache WHERE key = ? AND expires_at > ?', (key, now)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+
+@timed(db_latency)
+async def kv_set(key: str, value: str, expires_at: float) -> None:
+    async with db.write() as conn:
+        await conn.execute('''
+            INSERT INTO kv_cache (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+        ''', (key, value, expires_at))
+
+
+@timed(db_latency)
+async def kv_delete(key: str) -> None:
+    async with db.write() as conn:
+        await conn.execute('DELETE FROM kv_cache WHERE key = ?', (key,))
+
+
+@timed(db_latency)
+async def purge_kv_cache(now: float) -> None:
+    """
+    Удаляет устаревшие записи общего кэша.
+    """
+    async with db.write() as conn:
+        await conn.execute('DELETE FROM kv_cache WHERE expires_at <= ?', (now,))
+
+
+@timed(db_latency)
+async def acquire_lease(name: str, owner: str, ttl: float, now: float) -> bool:
+    """
+    Захватывает или продлевает аренду name на ttl секунд одним атомарным выражением.
+    Успешно, если аренда свободна, истекла или уже принадлежит owner.
+    """
+    async with db.write() as conn:
+        async with conn.execute('''
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at <= ?
+            RETURNING owner
+        ''', (name, owner, now + ttl, now)) as cursor:
+            return await cursor.fetchone() is not None
+
+
+@timed(db_latency)
+async def release_lease(name: str, owner: str) -> None:
+    async with db.write() as conn:
+        await conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+
+async def iter_daily_stats(day_from: str, day_to: str) -> AsyncIterator[Tuple[str, str, str, int]]:
+    """
+    Строки дневной сводки (day, metric, key, value) за период [day_from, day_to] по порядку дней.
+    Читаются курсором по мере обработки, без загрузки всей выборки в память.
+    """
+    async with db.read() as conn:
+        async with conn.execute('''
+            SELECT day, metric, key, value FROM daily_stats
+            WHERE day BETWEEN ? AND ? ORDER BY day
+        ''', (day_from, day_to)) as cursor:
+            async for row in cursor:
+                yield tuple(row)
@@ -0,0 +1,18 @@
+from aiogram import Dispatcher
+
+from app.context import AppContext
+from app.handlers import router
+from app.middlewares import setup_metrics, setup_throttling, setup_priorities
+
+
+def build_dispatcher(ctx: AppContext) -> Dispatcher:
+    """
+    Диспетчер с обработчиками и всеми middleware в рабочем порядке.
+    Используется ботом (run.py) и нагрузочным тестом, чтобы тест измерял тот же стек.
+    """
+    dp = Dispatcher(ctx=ctx)
+    dp.include_router(router)
+    setup_metrics(dp)
+    setup_throttling(dp)
+    setup_priorities(dp)
+    return dp
@@ -1,28 +1,59 @@
-import httpx
+import asyncio
+import logging
+from collections import namedtuple
+from typing import Optional
 from datetime import datetime
 from aiogram import Router, F
-from aiogram.filters import CommandStart, CommandObject
-from aiogram.types import Message, CallbackQuery
+from aiogram.filters import Command, CommandStart, CommandObject, ExceptionTypeFilter
+from aiogram.types import Message, CallbackQuery, ErrorEvent
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.utils.deep_linking import create_start_link, decode_payload
 
-from marzban import MarzbanAPI, UserCreate, UserModify, ProxySettings
-from config import MARZBAN_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD, prices, main_text, connect_text
+from marzban import UserCreate, UserModify, ProxySettings
+from config import prices, REFERRAL_BONUS_DAYS, main_text, connect_text, USER_CACHE_SIZE, USER_CACHE_TTL, CACHE_BACKEND, LOCK_BACKEND, ADMIN_TELEGRAM_ID
 
 from app.utils import send_message_to_user
 from app.database import (
     add_payment_to_db, update_payment_status, add_user_to_db, 
-    user_use_trial_to_db, check_user_trial, add_referral_to_db, 
-    verify_referral, get_user_from_db
+    claim_trial, release_trial, add_referral_to_db, 
+    verify_referral, claim_payment, get_payment, unblock_user, release_referral, get_referral_stats
 )
 from app.keyboards import (
-    main_menu, sub_menu, go_main_menu, get_payment_menu, 
+    main_menu, sub_menu, go_main_menu, get_payment_menu, ref_menu, go_ref_menu,
     go_key_menu, get_key_menu, android_menu, ios_menu
 )
 from app.yoo_kassa import create_payment, check_payment
+from app.panel import PanelPool
+from app.cache import make_cache, TTLCache
+from app.locks import make_lock
+from app.resilience import ServiceUnavailable
+from app.metrics import collected
+from app.analytics import build_report
+from app.qr import qr_available, send_qr
+from app.context import AppContext
 
 router = Router()
-api = MarzbanAPI(base_url=MARZBAN_URL)
+logger = logging.getLogger(__name__)
+
+REFERRAL_BONUS = REFERRAL_BONUS_DAYS * 86400
+
+# Фоновые задачи (бонус рефереру); храним ссылки, чтобы задачи не собрал сборщик мусора
+_background_tasks = set()
+
+# Активации одного пользователя (кнопка, пробный период, вебхук) выполняются по очереди — во всех воркерах
+user_locks = make_lock('user', LOCK_BACKEND)
+# Итог проверки платежа: повторные нажатия «Проверить платеж» получают его без запросов к YooKassa и панели
+payment_results = TTLCache(maxsize=10000, ttl=600)
+
+collected('user_info_cache_total', 'Обращения к кэшу информации о подписке', 'result', lambda: user_info_cache.stats)
+collected('payment_results_cache_total', 'Проверки платежей: выполнены, взяты из кэша, объединены',
+          'result', lambda: payment_results.stats)
+
+# Ключ и срок подписки пользователя: экраны ключа и подключения не ходят в панель при каждом нажатии
+SubscriptionInfo = namedtuple('SubscriptionInfo', 'subscription_url expire')
+user_info_cache = make_cache('user_info', USER_CACHE_SIZE, USER_CACHE_TTL, CACHE_BACKEND,
+                             decode=lambda value: SubscriptionInfo(*value) if value else None)
 
 
 
@@ -35,16 +66,17 @@ async def handle_start_with_referral(message: Message, command: CommandObject):
         referral_user_id = str(message.from_user.id)
         referrer_user_id = decode_payload(args)
 
-        if not await get_user_from_db(referral_user_id) and not await verify_referral(referral_user_id, use=False):
-            await add_referral_to_db(referrer_user_id, referral_user_id)
+        if await add_referral_to_db(referrer_user_id, referral_user_id):
             await message.answer(
                 "🫂 Вы приглашены по реферальной ссылке!\n\n"
                 "🎁 При покупке подписки — 7 бонусных дней бесплатно!"
             )
+    await unblock_user(str(message.from_user.id))
     await message.answer(main_text, reply_markup=main_menu, parse_mode=ParseMode.HTML)
 
 @router.message(CommandStart())
 async def handle_start(message: Message):
+    await unblock_user(str(message.from_user.id))
     await message.answer(main_text, reply_markup=main_menu, parse_mode=ParseMode.HTML)
 
 
@@ -64,27 +96,39 @@ async def handle_sub(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data == 'ref')
-async def handle_referral(callback: CallbackQuery):
-    from run import bot  # потенциально вынести наружу
+async def handle_referral(callback: CallbackQuery, ctx: AppContext):
     await callback.answer()
     user_id = str(callback.from_user.id)
-    referral_link = await create_start_link(bot=bot, payload=user_id, encode=True)
+    referral_link = await create_start_link(bot=ctx.bot, payload=user_id, encode=True)
     await callback.message.edit_text(
         "🎁 Пригласите друга и получите по 7 дней подписки в подарок!\n\n"
         f"🫂 Отправьте другу вашу реферальную ссылку: <code>{referral_link}</code>",
-        reply_markup=go_main_menu,
+        reply_markup=ref_menu,
         parse_mode=ParseMode.HTML
     )
 
+
+@router.callback_query(F.data == 'my_referrals')
+async def handle_my_referrals(callback: CallbackQuery):
+    await callback.answer()
+    invited, converted, bonus_days = await get_referral_stats(str(callback.from_user.id))
+    await callback.message.edit_text(
+        "📊 Ваши рефералы\n\n"
+        f"🫂 Приглашено друзей: {invited}\n"
+        f"💳 Оформили подписку: {converted}\n"
+        f"🎁 Получено бонусных дней: {bonus_days}",
+        reply_markup=go_ref_menu
+    )
+
 @router.callback_query(F.data == 'main_menu')
 async def handle_main_menu(callback: CallbackQuery):
     await callback.answer()
     await callback.message.edit_text(main_text, reply_markup=main_menu, parse_mode=ParseMode.HTML)
 
 @router.callback_query(F.data == 'connect_android')
-async def handle_android(callback: CallbackQuery):
+async def handle_android(callback: CallbackQuery, ctx: AppContext):
     await callback.answer()
-    user_info = await get_user_info(callback)
+    user_info = await get_user_info(callback, ctx)
     await callback.message.edit_text(
         connect_text('Android', 'Google Play'),
         reply_markup=await android_menu(user_info.subscription_url),
@@ -92,9 +136,9 @@ async def handle_android(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data == 'connect_ios')
-async def handle_ios(callback: CallbackQuery):
+async def handle_ios(callback: CallbackQuery, ctx: AppContext):
     await callback.answer()
-    user_info = await get_user_info(callback)
+    user_info = await get_user_info(callback, ctx)
     await callback.message.edit_text(
         connect_text('iOS', 'App Store'),
         reply_markup=await ios_menu(user_info.subscription_url),
@@ -105,14 +149,17 @@ async def handle_ios(callback: CallbackQuery):
 # --- Пробный период --- #
 
 @router.callback_query(F.data == 'trial_5_days')
-async def handle_trial(callback: CallbackQuery):
+async def handle_trial(callback: CallbackQuery, ctx: AppContext):
     user_id = str(callback.from_user.id)
-    if await check_user_trial(user_id):
+    if not await claim_trial(user_id):
         await callback.answer('❌ Пробный период уже использован.', show_alert=True)
         return
     await callback.answer()
-    await user_use_trial_to_db(user_id)
-    await activate_subscription(callback, period=0, trial=True)
+    try:
+        await activate_subscription(callback, ctx, period=0, trial=True)
+    except Exception:
+        await release_trial(user_id)
+        raise
 
 
 # --- Оплата --- #
@@ -124,7 +171,7 @@ async def handle_payment_request(callback: CallbackQuery):
     period = int(callback.data.split("_")[1])
     price = prices.get(period)
     payment_url, label, payment_yoo_id, status = await create_payment(price, user_id, period)
-    await add_payment_to_db(label, user_id, price, status, payment_yoo_id)
+    await add_payment_to_db(label, user_id, price, status, payment_yoo_id, period)
 
     await callback.message.edit_text(
         f"💳 Оплатите подписку на {period} мес.\n\n"
@@ -133,71 +180,147 @@ async def handle_payment_request(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data.startswith("check_payment_"))
-async def handle_check_payment(callback: CallbackQuery):
+async def handle_check_payment(callback: CallbackQuery, ctx: AppContext):
     _, _, payment_yoo_id, period_str = callback.data.split("_")
     period = int(period_str)
-    if await check_payment(payment_yoo_id):
-        await update_payment_status("succeeded", payment_yoo_id)
-        await activate_subscription(callback, period)
-    else:
+    # Параллельные и повторные нажатия получают результат первой проверки
+    text = await payment_results.get_or_load(
+        payment_yoo_id,
+        lambda: confirm_payment(callback, ctx, payment_yoo_id, period),
+        remember=bool
+    )
+    if not text:
         await callback.answer('❌ Оплата не найдена. Попробуйте ещё проверить раз или обратитесь в поддержку.', show_alert=True)
+        return
+    await callback.answer()
+    try:
+        await callback.message.edit_text(text, reply_markup=go_key_menu)
+    except TelegramBadRequest:
+        # Сообщение уже изменено при первом нажатии
+        pass
+
+
+PAYMENT_CONFIRMED_TEXT = '✅ Платёж уже подтверждён, подписка активирована.'
+
+
+async def confirm_payment(callback: CallbackQuery, ctx: AppContext, payment_yoo_id: str, period: int) -> Optional[str]:
+    """
+    Проверяет платёж и активирует подписку ровно один раз.
+    Возвращает текст для пользователя или None, если оплата не найдена.
+    """
+    # Платёж мог уже подтвердить вебхук YooKassa или прошлое нажатие — тогда в шлюз не ходим
+    local = await get_payment(payment_yoo_id)
+    if not local:
+        return None
+    if local[3] == 'succeeded':
+        return PAYMENT_CONFIRMED_TEXT
+    if not await check_payment(payment_yoo_id):
+        return None
+    # Между проверками платёж мог подтвердить вебхук — активируем только один раз
+    claimed = await claim_payment(payment_yoo_id)
+    if not claimed:
+        return PAYMENT_CONFIRMED_TEXT
+    # Срок берётся из записи платежа; из кнопки — только для старых платежей без него
+    user_id, stored_period = claimed
+    try:
+        return await activate_user(ctx, user_id, str(callback.from_user.username), stored_period or period)
+    except Exception:
+        await update_payment_status(payment_yoo_id, 'pending')
+        raise
 
 
 # --- Подписка --- #
 
-async def activate_subscription(callback: CallbackQuery, period: int = 0, trial: bool = False):
-    user_id = str(callback.from_user.id)
-    username = str(callback.from_user.username)
-    token = await api.get_token(username=MARZBAN_USERNAME, password=MARZBAN_PASSWORD)
+async def activate_subscription(callback: CallbackQuery, ctx: AppContext, period: int = 0, trial: bool = False):
+    text = await activate_user(ctx, str(callback.from_user.id), str(callback.from_user.username), period, trial)
+    await callback.message.edit_text(text, reply_markup=go_key_menu)
 
-    try:
-        user_info = await api.get_user(username=user_id, token=token.access_token)
-        expiration_date = user_info.expire
-    except httpx.HTTPStatusError as e:
-        if e.response.status_code == 404:
-            user_info = None
-            expiration_date = 0
-        else:
-            raise
 
-    now = int(datetime.now().timestamp())
-    add_time = 5 * 86400 if trial else period * 30 * 86400
-    next_expire = max(expiration_date, now) + add_time
+async def activate_user(ctx: AppContext, user_id: str, username: str, period: int = 0, trial: bool = False) -> str:
+    """
+    Продлевает подписку пользователя в Marzban (или создаёт его) и начисляет реферальный бонус.
+    Новый срок вместе с бонусом считается заранее и записывается одним запросом,
+    бонус рефереру начисляется в фоне. Возвращает текст подтверждения для пользователя.
+    """
+    async with user_locks(user_id):
+        return await _activate_user(ctx, user_id, username, period, trial)
 
-    if not user_info:
-        await api.add_user(UserCreate(username=user_id, proxies={'vless': ProxySettings(flow='xtls-rprx-vision')},
-                                      expire=next_expire, note=username), token=token.access_token)
-    else:
-        await api.modify_user(user_id, UserModify(expire=next_expire), token=token.access_token)
 
-    # рефералка
-    is_ref, referrer_user_id = await verify_referral(user_id, use=True)
-    if is_ref:
-        next_expire += 7 * 86400
-        await api.modify_user(user_id, UserModify(expire=next_expire), token=token.access_token)
+async def _activate_user(ctx: AppContext, user_id: str, username: str, period: int, trial: bool) -> str:
+    await user_info_cache.invalidate(user_id)
+    # Запрос в панель идёт параллельно с проверкой реферала в базе
+    lookup = asyncio.ensure_future(ctx.panels.locate(user_id))
+    try:
+        is_ref, referrer_user_id = await verify_referral(user_id, use=True)
+    except BaseException:
+        # Запрос в панель не оставляем без ожидания
+        lookup.cancel()
+        await asyncio.gather(lookup, return_exceptions=True)
+        raise
+
+    try:
+        panel, user_info = await lookup
+        now = int(datetime.now().timestamp())
+        add_time = 5 * 86400 if trial else period * 30 * 86400
+        expiration_date = (user_info.expire or 0) if user_info else 0
+        next_expire = max(expiration_date, now) + add_time + (REFERRAL_BONUS if is_ref else 0)
+
+        if not user_info:
+            # Новый пользователь — на наименее загруженную панель
+            panel = await ctx.panels.choose()
+            user_info = await panel.call('add_user', UserCreate(username=user_id, proxies={'vless': ProxySettings(flow='xtls-rprx-vision')},
+                                                                expire=next_expire, note=username))
+            await ctx.panels.assign(user_id, panel)
+        else:
+            user_info = await panel.call('modify_user', user_id, UserModify(expire=next_expire))
+    except Exception:
+        # Бонус не потрачен, если подписку продлить не удалось
+        if is_ref:
+            await release_referral(user_id)
+        raise
 
-        referrer_info = await api.get_user(referrer_user_id, token=token.access_token)
-        referrer_new_exp = max(referrer_info.expire, now) + 7 * 86400
-        await api.modify_user(referrer_user_id, UserModify(expire=referrer_new_exp), token=token.access_token)
-        await send_message_to_user(referrer_user_id)
+    if is_ref:
+        task = asyncio.create_task(_apply_referrer_bonus(ctx, referrer_user_id))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
 
-    user_info = await api.get_user(user_id, token=token.access_token)
-    await add_user_to_db(user_id, username, datetime.fromtimestamp(user_info.expire), trial)
+    await user_info_cache.set(user_id, SubscriptionInfo(user_info.subscription_url, next_expire))
+    await add_user_to_db(user_id, username, next_expire, trial)
 
     # текст
     if trial:
-        text = '✅ Пробный период на 5 дней активирован!'
+        return '✅ Пробный период на 5 дней активирован!'
     elif is_ref:
-        text = f'✅ Подписка активирована на {period} мес.\n🎁 +7 бонусных дней от друга!'
-    else:
-        text = f'✅ Подписка активирована на {period} мес.'
+        return f'✅ Подписка активирована на {period} мес.\n🎁 +7 бонусных дней от друга!'
+    return f'✅ Подписка активирована на {period} мес.'
 
-    await callback.message.edit_text(text, reply_markup=go_key_menu)
+
+async def drain_background_tasks() -> None:
+    """Дожидается фоновых задач (например, при остановке бота)."""
+    while _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+
+async def _apply_referrer_bonus(ctx: AppContext, referrer_user_id: str) -> None:
+    """Продлевает подписку рефереру на 7 дней и уведомляет его."""
+    try:
+        async with user_locks(referrer_user_id):
+            panel, referrer_info = await ctx.panels.locate(referrer_user_id)
+            if not referrer_info:
+                logger.warning(f"Реферер {referrer_user_id} не найден в Marzban, бонус не начислен")
+                return
+            now = int(datetime.now().timestamp())
+            referrer_new_exp = max(referrer_info.expire or 0, now) + REFERRAL_BONUS
+            await panel.call('modify_user', referrer_user_id, UserModify(expire=referrer_new_exp))
+            await user_info_cache.invalidate(referrer_user_id)
+        await send_message_to_user(ctx.bot, referrer_user_id)
+    except Exception:
+        logger.exception(f"Не удалось начислить реферальный бонус пользователю {referrer_user_id}")
 
 
 @router.callback_query(F.data == 'key')
-async def handle_key(callback: CallbackQuery):
-    user_info = await get_user_info(callback)
+async def handle_key(callback: CallbackQuery, ctx: AppContext):
+    user_info = await get_user_info(callback, ctx)
     if user_info:
         expire_date = datetime.fromtimestamp(user_info.expire)
         days_left = (expire_date - datetime.now()).days + 1
@@ -209,21 +332,72 @@ async def handle_key(callback: CallbackQuery):
                 f'📆 Подписка активна до: {expire_date.strftime("%d.%m.%Y")}\n'
                 f'⏳ Осталось дней: {days_left}\n\n'
                 '📱 Выберите устройство для подключения:',
-                reply_markup=await get_key_menu(user_info.subscription_url),
+                reply_markup=await get_key_menu(user_info.subscription_url, qr=qr_available()),
                 parse_mode=ParseMode.HTML
             )
     else:
         await callback.message.edit_text('❌ У вас нет активной подписки.', reply_markup=go_main_menu)
 
 
+@router.callback_query(F.data == 'key_qr')
+async def handle_key_qr(callback: CallbackQuery, ctx: AppContext):
+    await callback.answer()
+    user_info = await get_user_info(callback, ctx)
+    if not user_info or not qr_available():
+        return
+    await send_qr(callback.message, user_info.subscription_url,
+                  '📷 Отсканируйте QR-код камерой другого устройства, чтобы добавить подписку.')
+
+
+# --- Ошибки --- #
+
+SERVICE_BUSY_TEXT = '⏳ Сервис сейчас перегружен. Попробуйте, пожалуйста, через минуту.'
+
+
+@router.errors(ExceptionTypeFilter(ServiceUnavailable))
+async def handle_service_unavailable(event: ErrorEvent):
+    """Панель недоступна или перегружена: короткий ответ пользователю вместо зависшей кнопки."""
+    logger.warning(f"Обновление {event.update.update_id} отклонено: {event.exception}")
+    callback, message = event.update.callback_query, event.update.message
+    if callback:
+        try:
+            await callback.answer(SERVICE_BUSY_TEXT, show_alert=True)
+            return
+        except TelegramBadRequest:
+            # На нажатие уже ответили в обработчике — сообщаем в чат
+            message = callback.message
+    if message:
+        try:
+            await message.answer(SERVICE_BUSY_TEXT)
+        except TelegramBadRequest as e:
+            logger.warning(f"Не удалось сообщить о недоступности сервиса: {e}")
+
+
+# --- Админ --- #
+
+ADMIN_ID = int(ADMIN_TELEGRAM_ID) if ADMIN_TELEGRAM_ID else None
+
+
+@router.message(Command('stats'), F.from_user.id == ADMIN_ID)
+async def handle_stats(message: Message, command: CommandObject):
+    """/stats [дней] — выручка, оплаты по тарифам, новые и пробные пользователи из дневной сводки."""
+    days = int(command.args) if command.args and command.args.isdigit() else 30
+    await message.answer(await build_report(days))
+
+
 # --- Утилиты --- #
 
-async def get_user_info(callback: CallbackQuery):
+async def get_user_info(callback: CallbackQuery, ctx: AppContext):
+    """
+    Ключ и срок подписки пользователя (SubscriptionInfo) или None, если пользователя нет в панели.
+    Ответ кэшируется на USER_CACHE_TTL секунд, параллельные запросы одного пользователя схлопываются.
+    """
     user_id = str(callback.from_user.id)
-    token = await api.get_token(username=MARZBAN_USERNAME, password=MARZBAN_PASSWORD)
-    try:
-        return await api.get_user(username=user_id, token=token.access_token)
-    except httpx.HTTPStatusError as e:
-        if e.response.status_code == 404:
-            return None
-        raise
+    return await user_info_cache.get_or_load(user_id, lambda: _load_user_info(ctx.panels, user_id))
+
+
+async def _load_user_info(panels: PanelPool, user_id: str):
+    _, user_info = await panels.locate(user_id)
+    if not user_info:
+        return None
+    return SubscriptionInfo(user_info.subscription_url, user_info.expire)
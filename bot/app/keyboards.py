@@ -24,6 +24,16 @@ go_main_menu = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="⬅️ На главную", callback_data="main_menu")]
 ])
 
+# Реферальная программа
+ref_menu = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📊 Мои рефералы", callback_data="my_referrals")],
+    [InlineKeyboardButton(text="⬅️ На главную", callback_data="main_menu")]
+])
+
+go_ref_menu = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⬅️ Назад", callback_data="ref")]
+])
+
 go_key_menu = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="🛡️ Подключиться", callback_data="key")]
 ])
@@ -37,16 +47,21 @@ async def get_payment_menu(url: str, price: int, payment_yoo_id: str, period: in
     ])
 
 # Меню подключения
-async def get_key_menu(url: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
+async def get_key_menu(url: str, qr: bool = False) -> InlineKeyboardMarkup:
+    rows = [
         [
             InlineKeyboardButton(text="🤖 Android", callback_data="connect_android"),
             InlineKeyboardButton(text="🍏 iOS", callback_data="connect_ios"),
         ],
         [InlineKeyboardButton(text="💻 Windows & macOS", url=TELETYPE_INSTRUCTION)],
+    ]
+    if qr:
+        rows.append([InlineKeyboardButton(text="📷 QR-код", callback_data="key_qr")])
+    rows += [
         [InlineKeyboardButton(text="⚙️ Инструкция", url=TELETYPE_INSTRUCTION)],
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="main_menu")]
-    ])
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 async def android_menu(url: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Optional
+
+from app.database import acquire_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+
+class Leadership:
+    """
+    Выбор ведущего процесса через аренду в SQLite.
+    Ведущий продлевает аренду каждые ttl/3 секунд; если он упал, аренду через ttl
+    забирает другой процесс. Используется, чтобы задачи планировщика выполнял только один воркер.
+    """
+
+    def __init__(self, name: str, ttl: float = 30.0):
+        self.name = name
+        self.ttl = ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def _renew(self) -> None:
+        try:
+            leader = await acquire_lease(self.name, self.owner, self.ttl, time.time())
+        except Exception as e:
+            logger.warning(f"Не удалось продлить аренду {self.name}: {e}")
+            leader = False
+        if leader != self.is_leader:
+            logger.info(f"{'Стал' if leader else 'Перестал быть'} ведущим процессом ({self.owner})")
+        self.is_leader = leader
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await self._renew()
+
+    async def start(self) -> None:
+        await self._renew()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+        if self.is_leader:
+            await release_lease(self.name, self.owner)
+            self.is_leader = False
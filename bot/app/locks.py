@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, Union
+
+from app.database import acquire_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLock:
+    """
+    Асинхронные блокировки по ключу (например, по user_id).
+    Блокировка существует, пока её кто-то держит или ждёт, поэтому память не растёт
+    с числом пользователей.
+    """
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users: Dict[Hashable, int] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+
+    def locked(self, key: Hashable) -> bool:
+        return key in self._locks and self._locks[key].locked()
+
+
+class LeaseLock:
+    """
+    Блокировки по ключу, общие для всех процессов бота: аренда в таблице leases
+    (как у выбора ведущего процесса в app/leader.py).
+    Внутри процесса ожидающие сначала выстраиваются в очередь KeyedLock и не опрашивают базу.
+    Пока блокировка удерживается, аренда продлевается; аренда упавшего процесса истекает через ttl.
+    """
+
+    def __init__(self, namespace: str, ttl: float = 30.0, poll: float = 0.05, max_poll: float = 0.5):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.poll = poll
+        self.max_poll = max_poll
+        self._local = KeyedLock()
+
+    async def _renew(self, name: str, owner: str) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await acquire_lease(name, owner, self.ttl, time.time())
+            except Exception as e:
+                logger.warning(f"Не удалось продлить блокировку {name}: {e}")
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+        name = f'{self.namespace}:{key}'
+        owner = f'{os.getpid()}:{uuid.uuid4().hex}'
+        async with self._local(key):
+            delay = self.poll
+            while not await acquire_lease(name, owner, self.ttl, time.time()):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_poll)
+            renew = asyncio.create_task(self._renew(name, owner))
+            try:
+                yield
+            finally:
+                renew.cancel()
+                await release_lease(name, owner)
+
+    def locked(self, key: Hashable) -> bool:
+        """Только для текущего процесса."""
+        return self._local.locked(key)
+
+
+def make_lock(namespace: str, backend: str) -> Union[KeyedLock, LeaseLock]:
+    """Создаёт блокировки по ключу с хранилищем, выбранным в конфиге (memory или sqlite)."""
+    if backend == 'sqlite':
+        return LeaseLock(namespace)
+    return KeyedLock()
@@ -0,0 +1,201 @@
+import functools
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм по умолчанию (сек.)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Гистограмма задержек с метками.
+    Для каждого набора меток хранит счётчики по корзинам, сумму и количество наблюдений.
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # метки -> [счётчики корзин (+Inf последней), сумма, количество]
+        self._series: Dict[LabelKey, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Замеряет время выполнения блока."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def track(self, **labels: str) -> Iterator[None]:
+        """Замеряет время выполнения блока с меткой outcome (ok или error)."""
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self.observe(time.perf_counter() - start, outcome=outcome, **labels)
+
+    def totals(self) -> Dict[LabelKey, Tuple[int, float]]:
+        """Количество и сумма наблюдений по наборам меток."""
+        return {key: (count, total) for key, (_, total, count) in self._series.items()}
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f'{self.name}_bucket{_format_labels(key, ("le", le))} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(key)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(key)} {count}'
+
+
+class Counter:
+    """Счётчик событий с метками."""
+    type = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(key)} {_format_value(value)}'
+
+
+class CollectedMetric:
+    """
+    Метрика, значения которой читаются в момент запроса, например из словаря stats
+    кэша: collect возвращает {значение метки: число}. Если меток несколько, label — кортеж
+    имён, а ключи словаря — кортежи значений.
+    """
+
+    def __init__(self, name: str, description: str, label: Union[str, Tuple[str, ...]],
+                 collect: Callable[[], Dict[Any, float]], type: str = 'counter'):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.collect = collect
+        self.type = type
+
+    def samples(self) -> Iterator[str]:
+        labels = self.label if isinstance(self.label, tuple) else (self.label,)
+        for value, number in sorted(self.collect().items()):
+            values = value if isinstance(value, tuple) else (value,)
+            key = tuple(zip(labels, map(str, values)))
+            yield f'{self.name}{_format_labels(key)} {_format_value(number)}'
+
+
+# Все созданные метрики
+REGISTRY: List[Any] = []
+
+
+def histogram(name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    """Создаёт гистограмму и регистрирует её."""
+    metric = Histogram(name, description, buckets)
+    REGISTRY.append(metric)
+    return metric
+
+
+def counter(name: str, description: str) -> Counter:
+    """Создаёт счётчик и регистрирует его."""
+    metric = Counter(name, description)
+    REGISTRY.append(metric)
+    return metric
+
+
+def collected(name: str, description: str, label: Union[str, Tuple[str, ...]], collect: Callable[[], Dict[Any, float]],
+              type: str = 'counter') -> CollectedMetric:
+    """Регистрирует метрику, значения которой берутся из collect при каждом запросе."""
+    metric = CollectedMetric(name, description, label, collect, type)
+    REGISTRY.append(metric)
+    return metric
+
+
+def timed(metric: Histogram, label: str = 'query'):
+    """Декоратор корутины: замеряет время вызова с меткой label=<имя функции> и outcome."""
+    def decorator(func: Callable[..., Awaitable[Any]]):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metric.track(**{label: func.__name__}):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def start_metrics_server(host: str, port: int) -> Optional[web.AppRunner]:
+    """
+    Запускает HTTP-сервер с /metrics. Возвращает runner для остановки
+    или None, если порт не задан.
+    """
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,171 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+from app.metrics import histogram, counter, collected
+from app.priority import PriorityScheduler
+from app.throttling import RateLimiter
+from config import (
+    THROTTLE_RATE, THROTTLE_BURST, SCHEDULER_QUEUE_TIMEOUT,
+    throttle_costs, scheduler_classes, scheduler_shed, scheduler_routes
+)
+
+update_latency = histogram('bot_update_seconds', 'Полное время обработки обновления Telegram')
+handler_latency = histogram('bot_handler_seconds', 'Время выполнения обработчиков бота')
+throttled = counter('bot_throttled_total', 'Нажатия кнопок, отсечённые антифлудом (limited) или объединённые с уже идущими (coalesced)')
+
+scheduler_shed_total = counter('bot_scheduler_shed_total', 'Обновления, отклонённые планировщиком при перегрузке')
+
+THROTTLE_TEXT = '⏳ Слишком много нажатий, подождите пару секунд.'
+BUSY_TEXT = '⏳ Сейчас очень много запросов. Попробуйте, пожалуйста, через минуту.'
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на dp.update: время обработки обновления целиком
+    (фильтры, middleware, обработчик) по типу события.
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: Update, data: Dict[str, Any]) -> Any:
+        with update_latency.track(event_type=event.event_type):
+            return await handler(event, data)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware на наблюдателях событий: время конкретного обработчика
+    (handle_sub, handle_key, handle_check_payment, ...).
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get('handler')
+        name = getattr(handler_object.callback, '__name__', 'unknown') if handler_object else 'unknown'
+        with handler_latency.track(handler=name):
+            return await handler(event, data)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на dp.callback_query: антифлуд кнопок до фильтров и обработчиков.
+
+    - Повторное нажатие той же кнопки, пока первое ещё обрабатывается, не запускает
+      обработчик второй раз: оно дожидается первого и просто гасит «часики».
+    - Каждое нажатие списывает из корзины пользователя жетоны по throttle_costs;
+      если их не хватает, пользователь получает короткий ответ без обращения к Marzban и YooKassa.
+
+    Лимиты считаются в памяти процесса (в режиме вебхука — на каждого воркера отдельно).
+    """
+
+    def __init__(self, limiter: RateLimiter, costs: Dict[str, float]):
+        self.limiter = limiter
+        # Сначала более длинные префиксы
+        self.costs = sorted(costs.items(), key=lambda item: -len(item[0]))
+        self._pending: Dict[Tuple[int, str], asyncio.Event] = {}
+
+    def cost(self, callback_data: str) -> float:
+        for prefix, cost in self.costs:
+            if callback_data.startswith(prefix):
+                return cost
+        return 1
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: CallbackQuery, data: Dict[str, Any]) -> Any:
+        key = (event.from_user.id, event.data or '')
+        pending = self._pending.get(key)
+        if pending is not None:
+            throttled.inc(reason='coalesced')
+            await pending.wait()
+            await self._answer(event)
+            return None
+
+        if not self.limiter.consume(event.from_user.id, self.cost(key[1])):
+            throttled.inc(reason='limited')
+            await self._answer(event, THROTTLE_TEXT)
+            return None
+
+        done = self._pending[key] = asyncio.Event()
+        try:
+            return await handler(event, data)
+        finally:
+            del self._pending[key]
+            done.set()
+
+    @staticmethod
+    async def _answer(callback: CallbackQuery, text: Optional[str] = None) -> None:
+        try:
+            await callback.answer(text)
+        except TelegramBadRequest:
+            # Запрос устарел — ответить уже нельзя
+            pass
+
+
+class PriorityMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на сообщениях и нажатиях: обработчик выполняется в пуле своего
+    класса приоритета (оплата, активация, ключ, навигация). Нажатия и сообщения низших классов
+    при перегрузке получают быстрый ответ вместо ожидания в очереди.
+    """
+
+    def __init__(self, scheduler: PriorityScheduler, routes: Dict[str, str]):
+        self.scheduler = scheduler
+        self.routes = sorted(routes.items(), key=lambda item: -len(item[0]))
+
+    def classify(self, event: TelegramObject) -> str:
+        if isinstance(event, CallbackQuery):
+            for prefix, name in self.routes:
+                if (event.data or '').startswith(prefix):
+                    return name
+        return 'navigation'
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        name = self.classify(event)
+        if self.scheduler.should_shed(name):
+            scheduler_shed_total.inc(priority=name)
+            await self._reject(event)
+            return None
+        async with self.scheduler.slot(name):
+            return await handler(event, data)
+
+    @staticmethod
+    async def _reject(event: TelegramObject) -> None:
+        try:
+            if isinstance(event, (CallbackQuery, Message)):
+                await event.answer(BUSY_TEXT)
+        except TelegramBadRequest:
+            pass
+
+
+def setup_priorities(dp) -> PriorityMiddleware:
+    """
+    Подключает планировщик обновлений по приоритетам.
+    Вызывать после setup_throttling: отсечённые антифлудом нажатия не занимают места в очереди.
+    """
+    scheduler = PriorityScheduler(scheduler_classes, scheduler_shed, SCHEDULER_QUEUE_TIMEOUT)
+    middleware = PriorityMiddleware(scheduler, scheduler_routes)
+    dp.message.outer_middleware(middleware)
+    dp.callback_query.outer_middleware(middleware)
+    collected('bot_scheduler_updates', 'Обновления в работе и в очереди по классам приоритета',
+              ('priority', 'state'), scheduler.stats, type='gauge')
+    return middleware
+
+
+def setup_throttling(dp) -> ThrottlingMiddleware:
+    """Подключает антифлуд кнопок к диспетчеру."""
+    middleware = ThrottlingMiddleware(RateLimiter(THROTTLE_RATE, THROTTLE_BURST), throttle_costs)
+    dp.callback_query.outer_middleware(middleware)
+    collected('bot_throttle_buckets', 'Пользователей с неполной корзиной антифлуда', 'state',
+              lambda: {'tracked': len(middleware.limiter)}, type='gauge')
+    return middleware
+
+
+def setup_metrics(dp) -> None:
+    """Подключает middleware метрик к диспетчеру (действуют и для вложенных роутеров)."""
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
@@ -0,0 +1,349 @@
+import asyncio
+import base64
+import json
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+from marzban import MarzbanAPI, UserResponse
+
+from config import (
+    MARZBAN_PANELS, MARZBAN_CAPACITY, MARZBAN_TIMEOUT, MARZBAN_MAX_CONNECTIONS, MARZBAN_KEEPALIVE,
+    MARZBAN_DEADLINE, MARZBAN_RETRIES, MARZBAN_RETRY_DELAY, MARZBAN_CONCURRENCY, MARZBAN_QUEUE_TIMEOUT,
+    MARZBAN_RESERVED, MARZBAN_BREAKER_FAILURES, MARZBAN_BREAKER_RECOVERY, scheduler_classes, scheduler_shed
+)
+from app.database import get_user_panel, set_user_panels, count_users_by_panel
+from app.metrics import histogram, counter, collected
+from app.priority import current_priority
+from app.resilience import CircuitBreaker, Bulkhead, ServiceUnavailable
+
+logger = logging.getLogger(__name__)
+
+# Запас до истечения токена, после которого он обновляется заранее (сек.)
+TOKEN_REFRESH_MARGIN = 300
+# Время жизни токена, если не удалось прочитать exp из JWT (сек.)
+TOKEN_FALLBACK_TTL = 3600
+# Методы только для чтения: их безопасно повторять
+IDEMPOTENT_METHODS = {'get_user', 'get_users', 'get_user_rows', 'get_system_stats', 'get_inbounds', 'get_nodes'}
+# Классы приоритета обновлений, которым доступны резервные слоты панели (оплата, активация)
+PRIORITY_CLASSES = set(scheduler_classes) - set(scheduler_shed)
+# Как часто перечитывать из базы число пользователей на панелях для выбора панели (сек.)
+PANEL_COUNTS_TTL = 60
+
+
+def _token_expiry(access_token: str) -> Optional[float]:
+    """
+    Читает поле exp из полезной нагрузки JWT без проверки подписи.
+    Возвращает unix-время истечения или None, если токен не удалось разобрать.
+    """
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp else None
+    except (IndexError, ValueError, TypeError):
+        return None
+
+
+class TokenProvider:
+    """
+    Общий кэш админского токена Marzban.
+    Токен обновляется незадолго до истечения, параллельные обновления
+    схлопываются в один запрос логина.
+    """
+
+    def __init__(self, api: MarzbanAPI, username: str, password: str,
+                 refresh_margin: int = TOKEN_REFRESH_MARGIN):
+        self.api = api
+        self.username = username
+        self.password = password
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'refreshes': 0}
+
+    def _is_fresh(self) -> bool:
+        return self._token is not None and time.time() < self._expires_at - self.refresh_margin
+
+    async def get(self) -> str:
+        """Возвращает действующий токен, при необходимости логинится заново."""
+        if self._is_fresh():
+            self.stats['hits'] += 1
+            return self._token
+
+        self.stats['misses'] += 1
+        async with self._lock:
+            # Пока ждали блокировку, токен мог обновить другой запрос
+            if self._is_fresh():
+                return self._token
+            token = await self.api.get_token(username=self.username, password=self.password)
+            self._token = token.access_token
+            self._expires_at = _token_expiry(token.access_token) or time.time() + TOKEN_FALLBACK_TTL
+            self.stats['refreshes'] += 1
+            logger.info("Токен Marzban обновлён")
+            return self._token
+
+    def invalidate(self, token: Optional[str] = None) -> None:
+        """Сбрасывает токен (только если он совпадает с переданным, чтобы не сбросить уже новый)."""
+        if token is None or token == self._token:
+            self._token = None
+            self._expires_at = 0.0
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class PanelAPI(MarzbanAPI):
+    """
+    MarzbanAPI с общим настроенным HTTP-клиентом и облегчённой выборкой пользователей
+    для проходов по всей панели.
+    """
+
+    def __init__(self, base_url: str, client: httpx.AsyncClient, **kwargs: Any):
+        super().__init__(base_url=base_url, **kwargs)
+        # Конструктор библиотеки создаёт свой клиент; он не используется, но закрывается вместе с нашим
+        self._default_client, self.client = self.client, client
+
+    async def close(self) -> None:
+        await self._default_client.aclose()
+        await super().close()
+
+    async def get_user_rows(self, token: str, offset: Optional[int] = None, limit: Optional[int] = None,
+                            sort: Optional[str] = None) -> dict:
+        """
+        Страница /api/users как JSON ({'users': [...], 'total': N}) без построения моделей UserResponse:
+        на десятках тысяч пользователей их проверка занимает большую часть времени.
+        """
+        response = await self._request('GET', '/api/users', token, params={'offset': offset, 'limit': limit, 'sort': sort})
+        return response.json()
+
+
+def create_panel_api(base_url: str) -> MarzbanAPI:
+    """
+    Клиент Marzban с настроенным пулом keep-alive соединений.
+    HTTP/2 включается, если установлен пакет h2 (pip install httpx[http2]).
+    """
+    client = httpx.AsyncClient(
+        base_url=base_url,
+        verify=False,  # как у клиента MarzbanAPI по умолчанию
+        timeout=MARZBAN_TIMEOUT,
+        http2=_http2_available(),
+        limits=httpx.Limits(max_connections=MARZBAN_MAX_CONNECTIONS,
+                            max_keepalive_connections=MARZBAN_MAX_CONNECTIONS,
+                            keepalive_expiry=MARZBAN_KEEPALIVE),
+    )
+    return PanelAPI(base_url, client, timeout=MARZBAN_TIMEOUT)
+
+
+panel_latency = histogram('marzban_request_seconds', 'Время запросов к API Marzban')
+panel_rejected = counter('marzban_rejected_total', 'Запросы к Marzban, отклонённые без обращения к панели')
+
+
+def _is_outage(e: Exception) -> bool:
+    """Ошибка говорит о проблеме с панелью (таймаут, сеть, 5xx), а не о запросе (404, 422...)."""
+    if isinstance(e, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    return isinstance(e, httpx.HTTPStatusError) and (e.response.status_code >= 500 or e.response.status_code == 429)
+
+
+class Panel:
+    """
+    Одна панель Marzban: свой пул соединений, кэш токена, автомат защиты
+    и ограничение одновременных запросов.
+    """
+
+    def __init__(self, name: str, url: str, username: str, password: str, capacity: int = MARZBAN_CAPACITY):
+        self.name = name
+        self.url = url
+        self.capacity = capacity
+        self.api = create_panel_api(url)
+        self.token_provider = TokenProvider(self.api, username, password)
+        self.breaker = CircuitBreaker(MARZBAN_BREAKER_FAILURES, MARZBAN_BREAKER_RECOVERY)
+        self.bulkhead = Bulkhead(MARZBAN_CONCURRENCY, MARZBAN_QUEUE_TIMEOUT, MARZBAN_RESERVED)
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    async def _authorized_call(self, method: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """Вызов с кэшированным токеном; при ответе 401 токен сбрасывается и запрос повторяется один раз."""
+        token = await self.token_provider.get()
+        try:
+            return await method(*args, token=token, **kwargs)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 401:
+                raise
+            self.token_provider.invalidate(token)
+            token = await self.token_provider.get()
+            return await method(*args, token=token, **kwargs)
+
+    async def call(self, name: str, *args: Any, **kwargs: Any) -> Any:
+        """
+        Вызывает метод MarzbanAPI по имени с кэшированным токеном.
+        - Весь вызов (ожидание слота, логин, все попытки и паузы между ними) ограничен MARZBAN_DEADLINE,
+          одновременно идёт не больше MARZBAN_CONCURRENCY запросов, из них MARZBAN_RESERVED слотов —
+          только для обновлений оплаты и активации (классы не из scheduler_shed).
+        - Читающие запросы при сбое повторяются до MARZBAN_RETRIES раз с паузой со случайным разбросом,
+          пока на это хватает времени.
+        - После MARZBAN_BREAKER_FAILURES сбоев подряд запросы сразу отклоняются с ServiceUnavailable,
+          пока пробный запрос не покажет, что панель ожила.
+        Пример: await panel.call('get_user', user_id)
+        """
+        method = getattr(self.api, name)
+        breaker = self.breaker
+        attempts = MARZBAN_RETRIES if name in IDEMPOTENT_METHODS else 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + MARZBAN_DEADLINE
+        for attempt in range(1, attempts + 1):
+            if not breaker.allow():
+                panel_rejected.inc(panel=self.name, reason='breaker')
+                raise ServiceUnavailable(f'Панель Marzban {self.name} временно недоступна')
+            try:
+                async with self.bulkhead(deadline - loop.time(), priority=current_priority.get() in PRIORITY_CLASSES):
+                    with panel_latency.track(method=name, panel=self.name):
+                        result = await asyncio.wait_for(self._authorized_call(method, *args, **kwargs),
+                                                        max(deadline - loop.time(), 0))
+            except ServiceUnavailable:
+                panel_rejected.inc(panel=self.name, reason='bulkhead')
+                breaker.release_probe()
+                raise
+            except Exception as e:
+                if not _is_outage(e):
+                    # Панель ответила — значит, работает
+                    breaker.record_success()
+                    raise
+                was_open = breaker.state == CircuitBreaker.OPEN
+                breaker.record_failure()
+                if not was_open and breaker.state == CircuitBreaker.OPEN:
+                    logger.error(f"Marzban {self.name} не отвечает ({e!r}), "
+                                 f"запросы приостановлены на {MARZBAN_BREAKER_RECOVERY:.0f} с")
+                pause = random.uniform(0, MARZBAN_RETRY_DELAY * 2 ** (attempt - 1))
+                if attempt == attempts or breaker.state != CircuitBreaker.CLOSED or loop.time() + pause >= deadline:
+                    raise
+                logger.warning(f"Marzban {self.name} {name}: попытка {attempt} не удалась ({e!r}), повторяем")
+                await asyncio.sleep(pause)
+            except BaseException:
+                breaker.release_probe()
+                raise
+            else:
+                if breaker.state == CircuitBreaker.HALF_OPEN:
+                    logger.info(f"Marzban {self.name} снова отвечает, запросы возобновлены")
+                breaker.record_success()
+                return result
+
+    async def get_user(self, username: str) -> Optional[UserResponse]:
+        """Пользователь панели или None, если его здесь нет."""
+        try:
+            return await self.call('get_user', username)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+
+    async def close(self) -> None:
+        await self.api.close()
+
+
+class PanelPool:
+    """
+    Все панели Marzban. Привязка пользователя к панели хранится в таблице user_panels,
+    поэтому запросы по пользователю идут сразу на его панель; новые пользователи
+    заводятся на наименее загруженной доступной панели.
+    """
+
+    def __init__(self, panels: List[Panel]):
+        self.panels: Dict[str, Panel] = {panel.name: panel for panel in panels}
+        self.default = panels[0]
+        self._counts: Dict[str, int] = {}
+        self._counted_at = float('-inf')
+
+    def __iter__(self) -> Iterator[Panel]:
+        return iter(self.panels.values())
+
+    def __len__(self) -> int:
+        return len(self.panels)
+
+    async def locate(self, user_id: str) -> Tuple[Optional[Panel], Optional[UserResponse]]:
+        """
+        Панель и данные пользователя; (None, None), если его нет ни на одной панели.
+        Пользователя без привязки (заведённого до появления user_panels или вручную)
+        ищет на всех панелях параллельно и запоминает найденную.
+        """
+        panel = self.panels.get(await get_user_panel(user_id) or '')
+        if panel:
+            return panel, await panel.get_user(user_id)
+
+        panels = list(self)
+        results = await asyncio.gather(*(panel.get_user(user_id) for panel in panels), return_exceptions=True)
+        error = None
+        for panel, result in zip(panels, results):
+            if isinstance(result, BaseException):
+                error = error or result
+            elif result is not None:
+                await self.assign(user_id, panel)
+                return panel, result
+        if error:
+            # Пользователь может быть на недоступной панели — заводить его заново нельзя
+            raise error
+        return None, None
+
+    async def choose(self) -> Panel:
+        """Наименее загруженная панель (доля занятых мест от capacity) среди доступных."""
+        if len(self.panels) == 1:
+            return self.default
+        counts = await self._load_counts()
+        candidates = [panel for panel in self if panel.available] or list(self)
+        panel = min(candidates, key=lambda p: counts.get(p.name, 0) / max(p.capacity, 1))
+        if counts.get(panel.name, 0) >= panel.capacity:
+            logger.warning(f"Все панели Marzban заполнены, пользователь заводится на {panel.name}")
+        return panel
+
+    async def assign(self, user_id: str, panel: Panel) -> None:
+        """Запоминает, что пользователь заведён на panel."""
+        if await set_user_panels([(user_id, panel.name)]):
+            self._counts[panel.name] = self._counts.get(panel.name, 0) + 1
+
+    def invalidate_counts(self) -> None:
+        self._counted_at = float('-inf')
+
+    async def _load_counts(self) -> Dict[str, int]:
+        # Число пользователей на панелях перечитывается из базы раз в PANEL_COUNTS_TTL секунд,
+        # между перечитываниями учитываются только свои назначения
+        if time.monotonic() - self._counted_at > PANEL_COUNTS_TTL:
+            self._counts = await count_users_by_panel()
+            self._counted_at = time.monotonic()
+        return self._counts
+
+    async def close(self) -> None:
+        await asyncio.gather(*(panel.close() for panel in self))
+
+
+# Общий набор панелей для всех модулей
+panels = PanelPool([
+    Panel(settings['name'], settings['url'], settings['username'], settings['password'],
+          int(settings.get('capacity') or MARZBAN_CAPACITY))
+    for settings in MARZBAN_PANELS
+])
+
+collected('marzban_token_cache_total', 'Обращения к кэшу токена Marzban', ('panel', 'result'),
+          lambda: {(panel.name, result): value for panel in panels for result, value in panel.token_provider.stats.items()})
+collected('marzban_circuit_state', 'Состояние автомата защиты панели Marzban (1 — текущее)', ('panel', 'state'),
+          lambda: {(panel.name, state): int(panel.breaker.state == state) for panel in panels
+                   for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)},
+          type='gauge')
+collected('marzban_requests_in_flight', 'Запросы к Marzban в работе и предел одновременных', ('panel', 'kind'),
+          lambda: {(panel.name, kind): value for panel in panels
+                   for kind, value in (('in_flight', panel.bulkhead.in_flight), ('limit', panel.bulkhead.limit))},
+          type='gauge')
+collected('marzban_panel_users', 'Пользователи на панелях Marzban и их вместимость', ('panel', 'kind'),
+          lambda: {(panel.name, kind): value for panel in panels
+                   for kind, value in (('users', panels._counts.get(panel.name, 0)), ('capacity', panel.capacity))},
+          type='gauge')
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import time
+from typing import List, Set
+
+from marzban import UserResponse
+
+from config import PANEL_SYNC_PAGE_SIZE, PANEL_SYNC_CONCURRENCY
+from app.database import upsert_panel_users, prune_panel_users, set_user_panels
+from app.panel import Panel, panels
+
+logger = logging.getLogger(__name__)
+
+
+def _rows(users: List[UserResponse]) -> list:
+    return [(u.username, u.expire, u.used_traffic, u.status, u.subscription_url) for u in users]
+
+
+async def _sync_panel(panel: Panel, seen: Set[str]) -> int:
+    """
+    Забирает пользователей одной панели страницами через get_users (несколько страниц параллельно),
+    пишет изменившиеся строки в зеркало и привязку пользователей к панели. Возвращает число изменённых строк.
+    """
+    changed = 0
+
+    async def store(users: List[UserResponse]) -> None:
+        nonlocal changed
+        seen.update(u.username for u in users)
+        changed += await upsert_panel_users(_rows(users))
+        await set_user_panels([(u.username, panel.name) for u in users])
+
+    # Сортировка по username даёт стабильные страницы при параллельной выборке
+    first = await panel.call('get_users', offset=0, limit=PANEL_SYNC_PAGE_SIZE, sort='username')
+    await store(first.users)
+
+    semaphore = asyncio.Semaphore(PANEL_SYNC_CONCURRENCY)
+
+    async def fetch_page(offset: int) -> None:
+        async with semaphore:
+            page = await panel.call('get_users', offset=offset, limit=PANEL_SYNC_PAGE_SIZE, sort='username')
+        await store(page.users)
+
+    await asyncio.gather(*(fetch_page(offset) for offset in range(PANEL_SYNC_PAGE_SIZE, first.total, PANEL_SYNC_PAGE_SIZE)))
+    return changed
+
+
+async def sync_panel_users() -> int:
+    """
+    Синхронизирует локальное зеркало panel_users со всеми панелями Marzban (панели опрашиваются параллельно).
+    Пользователи, пропавшие из панелей, удаляются из зеркала только если ответили все панели.
+    Возвращает число изменённых строк.
+    """
+    start = time.perf_counter()
+    seen: Set[str] = set()
+    results = await asyncio.gather(*(_sync_panel(panel, seen) for panel in panels), return_exceptions=True)
+
+    changed, failed = 0, []
+    for panel, result in zip(panels, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Синхронизация с Marzban {panel.name} не удалась: {result!r}")
+            failed.append(panel.name)
+        else:
+            changed += result
+    panels.invalidate_counts()
+
+    removed = 0 if failed else await prune_panel_users(seen)
+    logger.info(
+        f"Синхронизация с Marzban: {len(seen)} пользователей на {len(panels) - len(failed)} из {len(panels)} панелей, "
+        f"изменено {changed}, удалено {removed} за {time.perf_counter() - start:.1f} с"
+    )
+    if failed and len(failed) == len(panels):
+        raise results[0]
+    return changed
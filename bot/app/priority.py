@@ -0,0 +1,87 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Iterable, Optional, Tuple
+
+from app.metrics import histogram
+from app.resilience import ServiceUnavailable
+
+scheduler_wait = histogram('bot_scheduler_wait_seconds', 'Ожидание свободного обработчика по классам приоритета')
+
+# Класс приоритета обновления, которое сейчас обрабатывается (None — фоновые задачи)
+current_priority: ContextVar[Optional[str]] = ContextVar('current_priority', default=None)
+
+
+class PriorityClass:
+    """Класс обновлений со своим пулом обработчиков и очередью ожидания."""
+
+    def __init__(self, name: str, workers: int, queue_depth: int, sheddable: bool):
+        self.name = name
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.sheddable = sheddable
+        self.running = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(workers)
+
+    @property
+    def saturated(self) -> bool:
+        return self.running >= self.workers
+
+
+class PriorityScheduler:
+    """
+    Ограниченные пулы обработчиков по классам приоритета (в порядке убывания приоритета).
+    Классы не делят слоты, поэтому платежи не ждут за навигацией по меню. Классы из shed
+    при перегрузке не ставятся в очередь: если их пул занят и очередь заполнена или ждут
+    более важные классы, обновление отклоняется сразу. Остальные ждут в очереди не дольше
+    queue_timeout, при полной очереди или по истечении времени — ServiceUnavailable.
+    """
+
+    def __init__(self, classes: Dict[str, Tuple[int, int]], shed: Iterable[str] = (), queue_timeout: float = 30):
+        shed = set(shed)
+        self.classes: Dict[str, PriorityClass] = {
+            name: PriorityClass(name, workers, queue_depth, name in shed)
+            for name, (workers, queue_depth) in classes.items()
+        }
+        self.queue_timeout = queue_timeout
+        self._order = list(self.classes)
+
+    def should_shed(self, name: str) -> bool:
+        cls = self.classes[name]
+        if not cls.sheddable or not cls.saturated:
+            return False
+        higher = self._order[:self._order.index(name)]
+        return cls.waiting >= cls.queue_depth or any(self.classes[h].waiting for h in higher)
+
+    @asynccontextmanager
+    async def slot(self, name: str) -> AsyncIterator[None]:
+        """
+        Ждёт свободный обработчик класса name и держит его до выхода из блока.
+        Внутри блока current_priority — name: по нему панели Marzban отдают резервные слоты.
+        """
+        cls = self.classes[name]
+        if cls.saturated and cls.waiting >= cls.queue_depth:
+            raise ServiceUnavailable(f'Очередь обработчиков {name} заполнена')
+        start = time.perf_counter()
+        cls.waiting += 1
+        try:
+            await asyncio.wait_for(cls._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise ServiceUnavailable(f'Нет свободного обработчика {name} за {self.queue_timeout:g} с') from None
+        finally:
+            cls.waiting -= 1
+            scheduler_wait.observe(time.perf_counter() - start, priority=name)
+        cls.running += 1
+        token = current_priority.set(name)
+        try:
+            yield
+        finally:
+            current_priority.reset(token)
+            cls.running -= 1
+            cls._semaphore.release()
+
+    def stats(self) -> Dict[Tuple[str, str], int]:
+        return {(cls.name, state): value for cls in self.classes.values()
+                for state, value in (('running', cls.running), ('waiting', cls.waiting), ('workers', cls.workers))}
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from typing import Dict, List, Optional
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message
+
+from app.database import get_qr_file_id, set_qr_file_id, delete_qr_file_id
+from app.locks import KeyedLock
+from app.metrics import histogram, counter
+from config import QR_CACHE_DIR, QR_CACHE_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+try:
+    import qrcode
+except ImportError:  # QR-коды — необязательная возможность
+    qrcode = None
+    logger.warning('Пакет qrcode не установлен: кнопка QR-кода ссылки подписки не показывается')
+
+qr_render_latency = histogram('bot_qr_render_seconds', 'Время отрисовки QR-кода')
+qr_sent = counter('bot_qr_sent_total', 'Отправленные QR-коды по источнику: file_id Telegram, диск или новая отрисовка')
+
+
+def qr_available() -> bool:
+    return qrcode is not None
+
+
+def url_hash(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _render(url: str) -> bytes:
+    """PNG с QR-кодом ссылки. Выполняется в отдельном потоке: отрисовка занимает десятки миллисекунд."""
+    image = qrcode.make(url, box_size=8, border=2)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class QRCache:
+    """
+    Картинки QR-кодов на диске, по файлу на ссылку (имя — sha256 ссылки).
+    Общий размер ограничен max_bytes: при превышении удаляются файлы, которые дольше всех не читали.
+    Одновременные запросы одной ссылки отрисовывают её один раз.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._locks = KeyedLock()
+        # Размеры файлов меняются только в цикле событий; поток вытеснения получает копию
+        self._sizes: Optional[Dict[str, int]] = None
+        self._index_lock = asyncio.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.png')
+
+    def _scan(self) -> Dict[str, int]:
+        os.makedirs(self.directory, exist_ok=True)
+        sizes = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.png'):
+                sizes[entry.name[:-4]] = entry.stat().st_size
+        return sizes
+
+    def _read(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)  # mtime — время последнего чтения, по нему вытесняем
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, path)
+
+    def _evict(self, sizes: Dict[str, int]) -> List[str]:
+        """Удаляет файлы, которые дольше всех не читали, пока кэш больше max_bytes. Возвращает их ключи."""
+        total = sum(sizes.values())
+        removed = []
+        if total <= self.max_bytes:
+            return removed
+        by_age = []
+        for key in sizes:
+            try:
+                by_age.append((os.stat(self._path(key)).st_mtime, key))
+            except FileNotFoundError:
+                by_age.append((0, key))
+        for _, key in sorted(by_age):
+            if total <= self.max_bytes:
+                break
+            total -= sizes[key]
+            removed.append(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+        return removed
+
+    async def _load_index(self) -> None:
+        async with self._index_lock:
+            if self._sizes is None:
+                self._sizes = await asyncio.to_thread(self._scan)
+
+    async def _store(self, key: str, data: bytes) -> None:
+        await asyncio.to_thread(self._write, key, data)
+        async with self._index_lock:
+            self._sizes[key] = len(data)
+            removed = await asyncio.to_thread(self._evict, dict(self._sizes))
+            for old in removed:
+                self._sizes.pop(old, None)
+
+    async def get_png(self, url: str) -> bytes:
+        key = url_hash(url)
+        async with self._locks(key):
+            await self._load_index()
+            data = await asyncio.to_thread(self._read, key)
+            if data is not None:
+                qr_sent.inc(source='disk')
+                return data
+            with qr_render_latency.track():
+                data = await asyncio.to_thread(_render, url)
+            qr_sent.inc(source='render')
+            try:
+                await self._store(key, data)
+            except OSError:
+                logger.exception('Не удалось сохранить QR-код на диск')
+            return data
+
+
+qr_cache = QRCache(QR_CACHE_DIR, QR_CACHE_MAX_MB * 1024 * 1024)
+
+
+async def send_qr(message: Message, url: str, caption: str) -> None:
+    """
+    Отправляет QR-код ссылки в чат message.
+    Картинка загружается в Telegram один раз: её file_id хранится в базе и используется повторно.
+    """
+    key = url_hash(url)
+    file_id = await get_qr_file_id(key)
+    if file_id:
+        try:
+            await message.answer_photo(file_id, caption=caption)
+            qr_sent.inc(source='file_id')
+            return
+        except TelegramBadRequest:
+            # file_id больше не действителен (например, сменился токен бота) — загружаем заново
+            await delete_qr_file_id(key)
+
+    png = await qr_cache.get_png(url)
+    sent = await message.answer_photo(BufferedInputFile(png, 'qr.png'), caption=caption)
+    if sent.photo:
+        await set_qr_file_id(key, sent.photo[-1].file_id)
@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from config import PANEL_SYNC_PAGE_SIZE, PANEL_SYNC_CONCURRENCY, RECONCILE_REPAIR, RECONCILE_BATCH
+from app.database import init_db, close_db, get_users_page, repair_users_expire
+from app.metrics import collected
+from app.panel import Panel, panels
+
+logger = logging.getLogger(__name__)
+
+# Сколько user_id каждой категории показывать в отчёте
+SAMPLE_SIZE = 10
+
+KINDS = {
+    'missing': 'нет в базе',
+    'extra': 'нет в панели',
+    'divergent': 'срок различается',
+    'legacy': 'срок записан не числом',
+    'duplicate': 'на нескольких панелях',
+}
+
+
+@dataclass
+class ReconcileReport:
+    panel_users: int = 0
+    local_users: int = 0
+    foreign: int = 0   # пользователи панели, заведённые не ботом (username — не id Telegram)
+    repaired: int = 0
+    counts: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(KINDS, 0))
+    samples: Dict[str, List[str]] = field(default_factory=lambda: {kind: [] for kind in KINDS})
+    seconds: float = 0.0
+
+    def note(self, kind: str, user_id: str) -> None:
+        self.counts[kind] += 1
+        if len(self.samples[kind]) < SAMPLE_SIZE:
+            self.samples[kind].append(user_id)
+
+    def format(self) -> str:
+        lines = [f'Сверка с Marzban за {self.seconds:.1f} с: в панелях {self.panel_users} '
+                 f'(не от бота {self.foreign}), в базе {self.local_users}']
+        for kind, title in KINDS.items():
+            if self.counts[kind]:
+                lines.append(f'  {title}: {self.counts[kind]} — {", ".join(self.samples[kind])}')
+        lines.append(f'  исправлено в базе: {self.repaired}')
+        return '\n'.join(lines)
+
+
+_last_report: Optional[ReconcileReport] = None
+collected('bot_reconcile_users', 'Расхождения базы и панелей Marzban по последней сверке', 'kind',
+          lambda: dict(_last_report.counts) if _last_report else {}, type='gauge')
+
+
+def normalize_expire(value: object) -> Optional[int]:
+    """
+    Срок из таблицы users в unix-время. Старые записи могли сохранить его строкой
+    с датой ('2025-03-01 12:00:00') или числом с плавающей точкой.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    text = str(value).strip()
+    if text.lstrip('-').isdigit():
+        return int(text)
+    try:
+        return int(datetime.fromisoformat(text).timestamp())
+    except ValueError:
+        return None
+
+
+# --- Потоки пользователей --- #
+
+async def _iter_panel(panel: Panel) -> AsyncIterator[dict]:
+    """
+    Пользователи панели (JSON из API) по возрастанию username. Следующие PANEL_SYNC_CONCURRENCY страниц
+    запрашиваются заранее, в памяти — только они.
+    """
+    async def fetch(offset: int):
+        return await panel.call('get_user_rows', offset=offset, limit=PANEL_SYNC_PAGE_SIZE, sort='username')
+
+    first = await fetch(0)
+    for user in first['users']:
+        yield user
+
+    offsets = iter(range(PANEL_SYNC_PAGE_SIZE, first['total'], PANEL_SYNC_PAGE_SIZE))
+    pending = deque(asyncio.ensure_future(fetch(offset)) for _, offset in zip(range(PANEL_SYNC_CONCURRENCY), offsets))
+    try:
+        while pending:
+            page = await pending.popleft()
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(asyncio.ensure_future(fetch(offset)))
+            for user in page['users']:
+                yield user
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _merge_panels() -> AsyncIterator[Tuple[Panel, dict]]:
+    """Пользователи всех панелей одним потоком по возрастанию username (слияние отсортированных потоков)."""
+    streams = [(panel, _iter_panel(panel)) for panel in panels]
+    heap = []
+    last: List[Optional[str]] = [None] * len(streams)
+
+    async def push(index: int) -> None:
+        user = await anext(streams[index][1], None)
+        if user is None:
+            return
+        # Порядок проверяем только для id Telegram: остальные имена сверка пропускает,
+        # а их сортировка зависит от сравнения строк в базе панели
+        username = user['username']
+        if username.isdigit():
+            if last[index] is not None and username < last[index]:
+                raise RuntimeError(f'Панель {streams[index][0].name} вернула пользователей не по порядку username')
+            last[index] = username
+        heapq.heappush(heap, (username, index, user))
+
+    await asyncio.gather(*(push(index) for index in range(len(streams))))
+    while heap:
+        _, index, user = heapq.heappop(heap)
+        yield streams[index][0], user
+        await push(index)
+
+
+async def _iter_local() -> AsyncIterator[Tuple[str, Optional[str], object]]:
+    after = ''
+    while True:
+        rows = await get_users_page(after, RECONCILE_BATCH)
+        for row in rows:
+            yield row
+        if len(rows) < RECONCILE_BATCH:
+            return
+        after = rows[-1][0]
+
+
+# --- Сверка --- #
+
+class _Repairs:
+    """
+    Исправления локальной базы, записываемые пачками по RECONCILE_BATCH.
+    Если по странице панели срок нужно уменьшить или убрать, пользователь перед записью
+    перечитывается из панели: страница могла устареть, пока шла сверка.
+    """
+
+    def __init__(self, report: ReconcileReport):
+        self.report = report
+        self.rows: List[Tuple[str, Optional[str], Optional[int], object]] = []
+        self.recheck: List[Tuple[str, Optional[str], object]] = []
+
+    async def add(self, user_id: str, username: Optional[str], expire: Optional[int], old: object) -> None:
+        current = normalize_expire(old)
+        if current is not None and (expire is None or expire < current):
+            self.recheck.append((user_id, username, old))
+        else:
+            self.rows.append((user_id, username, expire, old))
+        if len(self.rows) + len(self.recheck) >= RECONCILE_BATCH:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.recheck:
+            semaphore = asyncio.Semaphore(PANEL_SYNC_CONCURRENCY)
+
+            async def locate(user_id: str):
+                async with semaphore:
+                    return await panels.locate(user_id)
+
+            found = await asyncio.gather(*(locate(user_id) for user_id, _, _ in self.recheck))
+            for (user_id, username, old), (_, user) in zip(self.recheck, found):
+                expire = user.expire if user else None
+                if expire != old:
+                    self.rows.append((user_id, username, expire, old))
+            self.recheck.clear()
+        if self.rows:
+            self.report.repaired += await repair_users_expire(self.rows)
+            self.rows.clear()
+
+
+async def reconcile_users(repair: bool = RECONCILE_REPAIR) -> ReconcileReport:
+    """
+    Сверяет таблицу users со всеми панелями Marzban. Обе стороны читаются страницами
+    в порядке user_id/username и сливаются потоком, поэтому память не зависит от числа пользователей.
+    - missing: пользователь есть в панели, но в базе нет его срока;
+    - extra: в базе есть срок, а в панелях пользователя нет;
+    - divergent: сроки различаются; legacy: срок в базе записан не числом.
+    С repair локальная база исправляется по панели (сами панели не меняются).
+    """
+    global _last_report
+    start = time.perf_counter()
+    report = ReconcileReport()
+    repairs = _Repairs(report) if repair else None
+
+    async def handle(kind: str, user_id: str, username: Optional[str], expire: Optional[int], old: object) -> None:
+        report.note(kind, user_id)
+        if repairs:
+            await repairs.add(user_id, username, expire, old)
+
+    remote_stream, local_stream = _merge_panels(), _iter_local()
+    remote = await anext(remote_stream, None)
+    local = await anext(local_stream, None)
+    previous = None
+    while remote or local:
+        if remote and not remote[1]['username'].isdigit():
+            report.panel_users += 1
+            report.foreign += 1
+            remote = await anext(remote_stream, None)
+            continue
+        if remote and remote[1]['username'] == previous:
+            report.note('duplicate', previous)
+            remote = await anext(remote_stream, None)
+            continue
+
+        if local is None or (remote and remote[1]['username'] < local[0]):
+            user = remote[1]
+            report.panel_users += 1
+            previous = user['username']
+            await handle('missing', previous, user.get('note'), user.get('expire'), None)
+            remote = await anext(remote_stream, None)
+        elif remote is None or local[0] < remote[1]['username']:
+            user_id, _, old = local
+            report.local_users += 1
+            if normalize_expire(old) is not None:
+                await handle('extra', user_id, None, None, old)
+            local = await anext(local_stream, None)
+        else:
+            user, (user_id, username, old) = remote[1], local
+            report.panel_users += 1
+            report.local_users += 1
+            previous, expire = user['username'], user.get('expire')
+            current = normalize_expire(old)
+            if current is None and expire is not None:
+                await handle('missing', user_id, username, expire, old)
+            elif current != expire:
+                await handle('divergent', user_id, username, expire, old)
+            elif old is not None and not isinstance(old, int):
+                await handle('legacy', user_id, username, expire, old)
+            remote = await anext(remote_stream, None)
+            local = await anext(local_stream, None)
+
+    if repairs:
+        await repairs.flush()
+    report.seconds = time.perf_counter() - start
+    _last_report = report
+    logger.info(report.format())
+    return report
+
+
+async def scheduled_reconcile() -> None:
+    await reconcile_users()
+
+
+async def main() -> None:
+    """
+    Сверка из консоли (бот при этом может работать):
+    python -m app.reconcile [--repair]
+    """
+    parser = argparse.ArgumentParser(description="Сверка базы бота с панелями Marzban")
+    parser.add_argument("--repair", action="store_true", help="исправить локальную базу по панели")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        report = await reconcile_users(repair=args.repair)
+        print(report.format())
+    finally:
+        await panels.close()
+        await close_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+
+from config import reminder_stages, REMINDER_EXPIRED_WINDOW
+from app.broadcast import BroadcastReport, send_many
+from app.database import get_due_reminders, claim_reminders, release_reminders
+
+logger = logging.getLogger(__name__)
+
+
+def _stage_windows(now: int) -> List[Tuple[str, int, int, str]]:
+    """
+    Окна сроков истечения для этапов: (этап, expire_from, expire_to, текст).
+    Окна соседних этапов не пересекаются, поэтому пользователь получает только самое срочное
+    напоминание, даже если бот долго не работал.
+    """
+    stages = sorted(reminder_stages.items(), key=lambda item: item[1][0], reverse=True)
+    windows = []
+    for i, (stage, (offset, text)) in enumerate(stages):
+        if offset > 0:
+            next_offset = stages[i + 1][1][0] if i + 1 < len(stages) else 0
+            windows.append((stage, now + next_offset, now + offset, text))
+        else:
+            windows.append((stage, now - REMINDER_EXPIRED_WINDOW, now, text))
+    return windows
+
+
+async def send_reminders(bot: Bot, now: Optional[int] = None) -> BroadcastReport:
+    """
+    Отправляет напоминания об окончании подписки.
+    Кандидаты выбираются индексированным запросом по зеркалу panel_users, поэтому стоимость
+    зависит от числа пользователей к напоминанию, а не от общего числа пользователей.
+    Журнал reminder_log гарантирует не больше одного напоминания на этап и срок подписки.
+    """
+    now = now or int(time.time())
+    report = BroadcastReport()
+
+    for stage, expire_from, expire_to, text in _stage_windows(now):
+        claimed = await claim_reminders(stage, await get_due_reminders(stage, expire_from, expire_to))
+        if not claimed:
+            continue
+        report.total += len(claimed)
+        expires = dict(claimed)
+
+        async def on_batch(batch, stage=stage, expires=expires) -> None:
+            # Временные ошибки не фиксируем — напоминание уйдёт при следующем запуске
+            failed = [(user_id, expires[user_id]) for user_id, status, _ in batch if status == 'failed']
+            await release_reminders(stage, failed)
+
+        await send_many(bot, ((user_id, text) for user_id, _ in claimed), report, on_batch)
+
+    if report.total:
+        logger.info(f"Напоминания об окончании подписки отправлены:\n{report}")
+    return report
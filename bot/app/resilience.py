@@ -0,0 +1,102 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+
+class ServiceUnavailable(Exception):
+    """Внешний сервис временно недоступен: запрос отклонён без обращения к нему."""
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты внешнего сервиса.
+    После failure_threshold ошибок подряд размыкается (open) и сразу отклоняет запросы;
+    через recovery_time пропускает один пробный запрос (half_open) и по его результату
+    замыкается обратно или снова размыкается.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: int, recovery_time: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe = False
+
+    def allow(self) -> bool:
+        """Можно ли выполнить запрос сейчас (в half_open — только один пробный за раз)."""
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_time:
+            self.state = self.HALF_OPEN
+            self._probe = False
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._probe:
+            self._probe = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probe = False
+
+    def release_probe(self) -> None:
+        """Пробный запрос завершился без вывода о здоровье сервиса (например, 404) — пропустить следующий."""
+        if self.state == self.HALF_OPEN:
+            self._probe = False
+
+
+class Bulkhead:
+    """
+    Ограничение числа одновременных запросов к сервису.
+    Если слот не освободился за queue_timeout, запрос отклоняется с ServiceUnavailable,
+    а не копится в очереди. reserved слотов достаются только приоритетным запросам:
+    остальные занимают не больше limit - reserved.
+    """
+
+    def __init__(self, limit: int, queue_timeout: float, reserved: int = 0):
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.reserved = min(max(reserved, 0), limit - 1)
+        self._semaphore = asyncio.Semaphore(limit)
+        self._shared = asyncio.Semaphore(limit - self.reserved)
+        self.in_flight = 0
+
+    @asynccontextmanager
+    async def __call__(self, timeout: Optional[float] = None, priority: bool = False) -> AsyncIterator[None]:
+        """timeout — оставшееся время вызова, если оно меньше queue_timeout."""
+        if timeout is not None:
+            timeout = max(min(timeout, self.queue_timeout), 0)
+        else:
+            timeout = self.queue_timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        shared = None if priority or not self.reserved else self._shared
+        try:
+            if shared:
+                await asyncio.wait_for(shared.acquire(), timeout=timeout)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=max(deadline - loop.time(), 0))
+            except BaseException:
+                if shared:
+                    shared.release()
+                raise
+        except asyncio.TimeoutError:
+            raise ServiceUnavailable('Слишком много одновременных запросов') from None
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            if shared:
+                shared.release()
@@ -0,0 +1,50 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, Tuple
+
+
+class RateLimiter:
+    """
+    Token bucket по ключу (например, по user_id): у каждого ключа до burst жетонов,
+    которые пополняются со скоростью rate в секунду. Корзины хранятся в порядке последнего
+    обращения; при каждом вызове из начала удаляются уже наполнившиеся, поэтому память
+    зависит только от числа недавно активных пользователей и не превышает max_keys.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # ключ -> (жетоны, время обновления), от давно не обращавшихся к недавним
+        self._buckets: 'OrderedDict[Hashable, Tuple[float, float]]' = OrderedDict()
+
+    def _tokens(self, key: Hashable, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def consume(self, key: Hashable, cost: float = 1) -> bool:
+        """Списывает cost жетонов; False, если их не хватает (тогда ничего не списывается)."""
+        now = time.monotonic()
+        tokens = self._tokens(key, now)
+        cost = min(cost, self.burst)
+        allowed = tokens >= cost
+        self._buckets[key] = (tokens - cost if allowed else tokens, now)
+        self._buckets.move_to_end(key)
+        self._prune(now)
+        return allowed
+
+    def _prune(self, now: float) -> None:
+        """
+        Удаляет полные корзины из начала очереди, пока не встретится неполная.
+        Каждая корзина удаляется не больше раза после обращения, так что в среднем это O(1).
+        При переполнении удаляются и неполные: их пользователи дольше всех не нажимали кнопки.
+        """
+        buckets = self._buckets
+        while buckets:
+            key = next(iter(buckets))
+            if self._tokens(key, now) < self.burst and len(buckets) <= self.max_keys:
+                break
+            del buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
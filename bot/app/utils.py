@@ -1,3 +1,5 @@
-async def send_message_to_user(user_id: int):
-    from run import bot
+from aiogram import Bot
+
+
+async def send_message_to_user(bot: Bot, user_id: int):
     await bot.send_message(user_id, "🎁 Вы получили бонусные 7 дней подписки за друга!")
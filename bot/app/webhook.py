@@ -0,0 +1,125 @@
+import ipaddress
+import logging
+from typing import Optional
+
+from aiohttp import web
+
+from config import (
+    YOOKASSA_WEBHOOK_PORT, YOOKASSA_WEBHOOK_PATH,
+    YOOKASSA_WEBHOOK_STRICT, YOOKASSA_WEBHOOK_TRUST_PROXY
+)
+from app.database import claim_payment, get_payment, update_payment_status, get_user_from_db
+from app.context import AppContext
+from app.handlers import activate_user
+from app.keyboards import go_key_menu
+from app.yoo_kassa import check_payment
+
+logger = logging.getLogger(__name__)
+
+# Адреса, с которых YooKassa отправляет уведомления
+YOOKASSA_NETWORKS = [ipaddress.ip_network(net) for net in (
+    '185.71.76.0/27', '185.71.77.0/27', '77.75.153.0/25', '77.75.156.11/32',
+    '77.75.156.35/32', '77.75.154.128/25', '2a02:5180::/32',
+)]
+
+
+def _client_ip(request: web.Request) -> Optional[str]:
+    """
+    Адрес отправителя. За прокси берётся запись X-Forwarded-For, добавленная самым дальним
+    из YOOKASSA_WEBHOOK_TRUST_PROXY доверенных прокси: записи левее присылает сам клиент.
+    """
+    if YOOKASSA_WEBHOOK_TRUST_PROXY:
+        forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+        if len(forwarded) < YOOKASSA_WEBHOOK_TRUST_PROXY:
+            return None
+        return forwarded[-YOOKASSA_WEBHOOK_TRUST_PROXY]
+    return request.remote
+
+
+def _is_yookassa_ip(ip: Optional[str]) -> bool:
+    try:
+        address = ipaddress.ip_address(ip)
+    except (TypeError, ValueError):
+        return False
+    return any(address in network for network in YOOKASSA_NETWORKS)
+
+
+async def handle_yookassa_notification(request: web.Request) -> web.Response:
+    """
+    Принимает уведомление payment.succeeded и активирует подписку без нажатия «Проверить платеж».
+    Уведомления не подписываются, поэтому в строгом режиме проверяются IP отправителя
+    и статус платежа через API. Ответ не 200 заставит YooKassa повторить уведомление.
+    """
+    if YOOKASSA_WEBHOOK_STRICT and not _is_yookassa_ip(_client_ip(request)):
+        logger.warning(f"Уведомление YooKassa с неизвестного адреса: {_client_ip(request)}")
+        return web.Response(status=403)
+
+    try:
+        data = await request.json()
+        payment = data['object']
+        payment_yoo_id = payment['id']
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+
+    if data.get('event') != 'payment.succeeded':
+        return web.Response(status=200)
+
+    # Срок и сумма берутся из своей записи платежа: тело уведомления не подписано
+    local = await get_payment(payment_yoo_id)
+    if not local:
+        logger.warning(f"Уведомление YooKassa о неизвестном платеже {payment_yoo_id}")
+        return web.Response(status=200)
+    _, amount, period, _ = local
+    try:
+        paid = float(payment['amount']['value'])
+    except (KeyError, TypeError, ValueError):
+        return web.Response(status=400)
+    if paid != amount:
+        logger.error(f"Сумма в уведомлении ({paid}) не совпадает с платежом {payment_yoo_id} ({amount})")
+        return web.Response(status=200)
+    if period is None:
+        logger.error(f"Не удалось определить срок подписки для платежа {payment_yoo_id}")
+        return web.Response(status=200)
+
+    if YOOKASSA_WEBHOOK_STRICT and not await check_payment(payment_yoo_id):
+        return web.Response(status=400)
+
+    claimed = await claim_payment(payment_yoo_id)
+    if not claimed:
+        # Уже активирован кнопкой
+        return web.Response(status=200)
+    user_id, period = claimed
+
+    ctx: AppContext = request.app['ctx']
+    user = await get_user_from_db(user_id)
+    try:
+        text = await activate_user(ctx, user_id, str(user[1]) if user else 'None', period)
+    except Exception:
+        await update_payment_status(payment_yoo_id, 'pending')
+        logger.exception(f"Ошибка активации по уведомлению для платежа {payment_yoo_id}")
+        return web.Response(status=500)
+
+    try:
+        await ctx.bot.send_message(user_id, text, reply_markup=go_key_menu)
+    except Exception as e:
+        logger.warning(f"Подписка активирована, но сообщение {user_id} не отправлено: {e}")
+    logger.info(f"Платёж {payment_yoo_id} подтверждён уведомлением YooKassa")
+    return web.Response(status=200)
+
+
+def setup_webhook_routes(app: web.Application, ctx: AppContext) -> None:
+    app['ctx'] = ctx
+    app.router.add_post(YOOKASSA_WEBHOOK_PATH, handle_yookassa_notification)
+
+
+async def start_webhook_server(ctx: AppContext) -> Optional[web.AppRunner]:
+    """Запускает HTTP-сервер для уведомлений YooKassa, если задан YOOKASSA_WEBHOOK_PORT."""
+    if not YOOKASSA_WEBHOOK_PORT:
+        return None
+    app = web.Application()
+    setup_webhook_routes(app, ctx)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', YOOKASSA_WEBHOOK_PORT).start()
+    logging.info(f"Вебхук YooKassa слушает порт {YOOKASSA_WEBHOOK_PORT}{YOOKASSA_WEBHOOK_PATH}")
+    return runner
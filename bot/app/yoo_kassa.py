@@ -1,9 +1,19 @@
+import asyncio
+import time
 import uuid
 import logging
-from typing import Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Tuple, Optional
+import requests
+from requests.adapters import HTTPAdapter
 from yookassa import Configuration, Payment
+from yookassa.client import ApiClient
+from yookassa.domain.exceptions import (
+    AuthorizeError, BadRequestError, ForbiddenError, NotFoundError, UnauthorizedError
+)
 
 import config
+from app.metrics import histogram
 
 # Логгер
 logger = logging.getLogger(__name__)
@@ -13,6 +23,80 @@ logging.basicConfig(level=logging.INFO)
 Configuration.account_id = config.YOOKASSA_ID
 Configuration.secret_key = config.YOOKASSA_SECRET_KEY
 
+# SDK YooKassa синхронный, поэтому запросы выполняются в отдельном ограниченном пуле потоков
+_executor = ThreadPoolExecutor(max_workers=config.YOOKASSA_MAX_WORKERS, thread_name_prefix='yookassa')
+
+# Ошибки, которые не исправятся повтором запроса
+_PERMANENT_ERRORS = (AuthorizeError, BadRequestError, ForbiddenError, NotFoundError, UnauthorizedError)
+
+gateway_latency = histogram('yookassa_request_seconds', 'Время запросов к API YooKassa')
+
+
+class _TimeoutAdapter(HTTPAdapter):
+    """HTTPAdapter с таймаутом по умолчанию: SDK отправляет запросы без него."""
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or (config.YOOKASSA_CONNECT_TIMEOUT, config.YOOKASSA_TIMEOUT), **kwargs)
+
+
+class _GatewayClient(ApiClient):
+    """Клиент SDK с таймаутами соединения и чтения: зависший шлюз не держит поток пула бесконечно."""
+
+    def get_session(self):
+        session = super().get_session()
+        adapter = _TimeoutAdapter(max_retries=session.get_adapter('https://').max_retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def execute(self, *args):
+        try:
+            return super().execute(*args)
+        except requests.RequestException as e:
+            self._network_error = e
+            raise
+
+    def request(self, *args, **kwargs):
+        # SDK разбирает ошибку как ответ сервера и на таймауте падает с AttributeError — пробрасываем исходную
+        self._network_error = None
+        try:
+            return super().request(*args, **kwargs)
+        except AttributeError:
+            if self._network_error is not None:
+                raise self._network_error from None
+            raise
+
+
+class _Payment(Payment):
+    def __init__(self):
+        super().__init__()
+        self.client = _GatewayClient()
+
+
+async def _call_gateway(operation: str, func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Выполняет вызов SDK в пуле потоков с таймаутом и повторами.
+    Поток освобождают таймауты HTTP-запроса (_GatewayClient); wait_for — запасная граница сверху.
+    Повторять безопасно: создание платежа идёт с тем же idempotence_key, проверка — это GET.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(1, config.YOOKASSA_RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(_executor, func, *args),
+                timeout=config.YOOKASSA_CONNECT_TIMEOUT + config.YOOKASSA_TIMEOUT
+            )
+        except Exception as e:
+            gateway_latency.observe(time.perf_counter() - start, operation=operation, outcome='error')
+            if isinstance(e, _PERMANENT_ERRORS) or attempt == config.YOOKASSA_RETRIES:
+                raise
+            logger.warning(f"⚠️ YooKassa {operation}: попытка {attempt} не удалась ({e!r}), повторяем")
+            await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+        else:
+            gateway_latency.observe(time.perf_counter() - start, operation=operation, outcome='ok')
+            return result
+
 
 async def create_payment(price: float, user_id: int, period: int) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
     """
@@ -21,7 +105,7 @@ async def create_payment(price: float, user_id: int, period: int) -> Tuple[Optio
     """
     try:
         idempotence_key = str(uuid.uuid4())
-        payment = Payment.create({
+        payment = await _call_gateway('create', _Payment.create, {
             "amount": {
                 "value": f"{price:.2f}",
                 "currency": "RUB"
@@ -35,7 +119,8 @@ async def create_payment(price: float, user_id: int, period: int) -> Tuple[Optio
             },
             "capture": True,
             "metadata": {
-                "user_id": str(user_id)
+                "user_id": str(user_id),
+                "period": str(period)
             },
             "description": f"Оплата подписки на {period} мес."
         }, idempotence_key)
@@ -52,8 +137,8 @@ async def check_payment(payment_id: str) -> bool:
     Проверяет, был ли платёж оплачен.
     """
     try:
-        payment = Payment.find_one(payment_id)
+        payment = await _call_gateway('find_one', _Payment.find_one, payment_id)
         return payment.paid
     except Exception as e:
         logger.error(f"❌ Ошибка при проверке платежа: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,208 @@
+"""
+Микробенчмарки функций app/database.py на большой базе (см. generate_data.py).
+
+Сначала каждая функция замеряется отдельно, затем — под смешанной параллельной нагрузкой
+чтения и записи. Отчёт в JSON позволяет сравнивать изменения схемы, индексов и пула соединений.
+
+    python benchmarks/generate_data.py /tmp/bench.sqlite --users 1000000 --payments 5000000
+    python benchmarks/db_bench.py /tmp/bench.sqlite --json db_report.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+Op = Callable[[], Awaitable[object]]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по методу ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def summary(values: List[float], elapsed: float) -> dict:
+    return {
+        'count': len(values),
+        'ops_per_sec': len(values) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(values) / len(values) * 1000 if values else 0.0,
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000 if values else 0.0,
+    }
+
+
+def sample_keys(path: str, count: int, seed: int) -> Tuple[List[str], List[str]]:
+    """Случайные user_id и payment_yoo_id из базы (выборка по rowid, без сортировки всей таблицы)."""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    keys = []
+    for table, column in (('users', 'user_id'), ('payments', 'payment_yoo_id')):
+        max_rowid = conn.execute(f'SELECT max(rowid) FROM {table}').fetchone()[0] or 0
+        rowids = [rnd.randint(1, max_rowid) for _ in range(count)] if max_rowid else []
+        values = []
+        for chunk in range(0, len(rowids), 500):
+            part = rowids[chunk:chunk + 500]
+            values += [row[0] for row in conn.execute(
+                f'SELECT {column} FROM {table} WHERE rowid IN ({",".join("?" * len(part))})', part)]
+        if not values:
+            raise SystemExit(f"Таблица {table} пуста — сначала запустите generate_data.py")
+        keys.append(values)
+    counts = {table: conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+              for table in ('users', 'payments', 'referrals', 'panel_users')}
+    conn.close()
+    print(f"Строк в базе: {counts}")
+    return keys[0], keys[1]
+
+
+async def bench_single(name: str, op: Op, iterations: int) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        await op()
+        latencies.append(time.perf_counter() - t)
+    result = summary(latencies, time.perf_counter() - start)
+    print(f"{name:<38}{iterations:>7}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+          f"{result['p99_ms']:>10.2f}{result['ops_per_sec']:>12.0f}")
+    return result
+
+
+async def bench_mixed(ops: Dict[str, Tuple[float, Op]], concurrency: int, duration: float) -> dict:
+    """concurrency задач в течение duration выполняют операции, выбранные по весам."""
+    names = list(ops)
+    weights = [ops[name][0] for name in names]
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    deadline = time.perf_counter() + duration
+
+    async def worker(seed: int) -> None:
+        rnd = random.Random(seed)
+        while time.perf_counter() < deadline:
+            name = rnd.choices(names, weights)[0]
+            t = time.perf_counter()
+            try:
+                await ops[name][1]()
+            except Exception as e:
+                errors[f'{name}: {type(e).__name__}'] += 1
+                continue
+            latencies[name].append(time.perf_counter() - t)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    total = sum(len(values) for values in latencies.values())
+    print(f"\nСмешанная нагрузка: {concurrency} задач, {elapsed:.1f} с, {total / elapsed:.0f} операций/с, "
+          f"ошибки: {dict(errors) or 'нет'}")
+    for name, values in sorted(latencies.items()):
+        result = summary(values, elapsed)
+        print(f"  {name:<36}{result['count']:>7}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}")
+    return {
+        'concurrency': concurrency,
+        'elapsed': elapsed,
+        'ops_per_sec': total / elapsed if elapsed else 0.0,
+        'errors': dict(errors),
+        'operations': {name: summary(values, elapsed) for name, values in sorted(latencies.items())},
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    os.environ['DB_PATH'] = args.path
+    os.environ['DB_READERS'] = str(args.readers)
+    from app import database as d
+
+    user_ids, payment_ids = sample_keys(args.path, max(args.iterations, 1000), args.seed)
+    rnd = random.Random(args.seed)
+    now = int(time.time())
+
+    def user() -> str:
+        return rnd.choice(user_ids)
+
+    def payment() -> str:
+        return rnd.choice(payment_ids)
+
+    await d.init_db()
+    n = args.iterations
+    single: List[Tuple[str, Op, int]] = [
+        ('get_user_from_db', lambda: d.get_user_from_db(user()), n),
+        ('get_payments_from_db', lambda: d.get_payments_from_db(user()), n),
+        ('verify_referral', lambda: d.verify_referral(user()), n),
+        ('verify_referral(use=True)', lambda: d.verify_referral(user(), use=True), n // 5),
+        ('update_payment_status', lambda: d.update_payment_status(payment(), rnd.choice(('pending', 'succeeded'))), n // 2),
+        ('claim_payment', lambda: d.claim_payment(payment()), n // 5),
+        ('add_user_to_db', lambda: d.add_user_to_db(user(), 'bench', now + 86400, False), n // 2),
+        ('get_due_reminders', lambda: d.get_due_reminders('bench', now, now + 86400), 20),
+        ('get_inactive_panel_users', lambda: d.get_inactive_panel_users(now), args.full_scans),
+        ('get_all_users', lambda: d.get_all_users(), args.full_scans),
+        ('get_all_users(exclude_blocked=True)', lambda: d.get_all_users(exclude_blocked=True), args.full_scans),
+        ('get_all_payments_from_db', lambda: d.get_all_payments_from_db(), args.full_scans),
+    ]
+    mixed: Dict[str, Tuple[float, Op]] = {
+        'get_user_from_db': (40, lambda: d.get_user_from_db(user())),
+        'get_payments_from_db': (20, lambda: d.get_payments_from_db(user())),
+        'verify_referral': (20, lambda: d.verify_referral(user())),
+        'kv_get': (10, lambda: d.kv_get(f'user_info:{user()}', time.time())),
+        'update_payment_status': (4, lambda: d.update_payment_status(payment(), 'pending')),
+        'claim_payment': (2, lambda: d.claim_payment(payment())),
+        'add_user_to_db': (2, lambda: d.add_user_to_db(user(), 'bench', now + 86400, False)),
+        'kv_set': (2, lambda: d.kv_set(f'user_info:{user()}', '["/sub", 0]', time.time() + 30)),
+    }
+
+    report = {
+        'database': args.path,
+        'size_mb': Path(args.path).stat().st_size / 2 ** 20,
+        'sqlite_version': sqlite3.sqlite_version,
+        'python': platform.python_version(),
+        'readers': args.readers,
+        'pragmas': d.PRAGMAS,
+        'single': {},
+    }
+    try:
+        print(f"\n{'функция':<38}{'вызовов':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'оп/с':>12}")
+        for name, op, iterations in single:
+            if iterations > 0:
+                report['single'][name] = await bench_single(name, op, iterations)
+        report['mixed'] = await bench_mixed(mixed, args.concurrency, args.duration)
+        report['connection_wait'] = {
+            dict(key)['mode']: {'count': count, 'mean_ms': total / count * 1000 if count else 0.0}
+            for key, (count, total) in d.db_wait.totals().items()
+        }
+    finally:
+        await d.close_db()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарки функций базы данных")
+    parser.add_argument("path", help="база, созданная generate_data.py (будет изменена)")
+    parser.add_argument("--iterations", type=int, default=1000, help="вызовов точечных функций")
+    parser.add_argument("--full-scans", type=int, default=3, help="вызовов функций, читающих всю таблицу")
+    parser.add_argument("--concurrency", type=int, default=32, help="параллельных задач в смешанной нагрузке")
+    parser.add_argument("--duration", type=float, default=10, help="длительность смешанной нагрузки, сек.")
+    parser.add_argument("--readers", type=int, default=3, help="соединений на чтение в пуле (DB_READERS)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчёт в файл")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"\nОтчёт сохранён в {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Генератор синтетической базы бота большого объёма для бенчмарков.
+Схема создаётся обычным init_db (со всеми миграциями), затем таблицы заполняются
+пачками через executemany внутри транзакций.
+
+    python benchmarks/generate_data.py /tmp/bench.sqlite --users 1000000 --payments 5000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Iterator, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# Первый user_id синтетических пользователей (похож на реальные id Telegram)
+FIRST_USER_ID = 100_000_000
+STATUSES = ('succeeded',) * 8 + ('pending', 'canceled')
+AMOUNTS = (99, 299, 599)
+
+
+def _batches(rows: Iterator[tuple], size: int) -> Iterator[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _fill(conn: sqlite3.Connection, table: str, sql: str, rows: Iterator[tuple], total: int, batch_size: int) -> None:
+    start = time.perf_counter()
+    done = 0
+    for batch in _batches(rows, batch_size):
+        with conn:
+            conn.executemany(sql, batch)
+        done += len(batch)
+        print(f"\r{table}: {done}/{total}", end='', flush=True)
+    elapsed = time.perf_counter() - start
+    print(f"\r{table}: {total} строк за {elapsed:.1f} с ({total / elapsed if elapsed else 0:.0f} строк/с)")
+
+
+def generate(path: str, users: int, payments: int, referral_share: float, blocked_share: float,
+             batch_size: int = 10000, seed: int = 1) -> None:
+    rnd = random.Random(seed)
+    now = int(time.time())
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + users)
+    expires = [now + rnd.randint(-90, 180) * 86400 for _ in user_ids]
+
+    conn = sqlite3.connect(path)
+    # Только для наполнения: база создаётся заново, надёжность записи не нужна
+    conn.executescript('PRAGMA journal_mode = WAL; PRAGMA synchronous = OFF; PRAGMA cache_size = -200000;')
+
+    def user_rows() -> Iterator[Tuple]:
+        for user_id, expire in zip(user_ids, expires):
+            yield (str(user_id), f'user{user_id}', expire, int(rnd.random() < 0.3), int(rnd.random() < blocked_share))
+
+    def payment_rows() -> Iterator[Tuple]:
+        start_date = datetime.now() - timedelta(days=365)
+        for i in range(payments):
+            user_id = FIRST_USER_ID + rnd.randrange(users)
+            date = start_date + timedelta(seconds=rnd.randrange(365 * 86400))
+            yield (str(uuid.UUID(int=rnd.getrandbits(128))), str(user_id), rnd.choice(AMOUNTS),
+                   date.strftime('%Y-%m-%d %H:%M:%S'), rnd.choice(STATUSES), f'{i:08x}-{rnd.getrandbits(64):016x}')
+
+    def referral_rows() -> Iterator[Tuple]:
+        for user_id in user_ids[1:]:
+            if rnd.random() < referral_share:
+                referrer = FIRST_USER_ID + rnd.randrange(user_id - FIRST_USER_ID)
+                yield (str(referrer), str(user_id), int(rnd.random() < 0.5))
+
+    def panel_rows() -> Iterator[Tuple]:
+        for user_id, expire in zip(user_ids, expires):
+            yield (str(user_id), expire, rnd.choice((0, 0, rnd.randrange(1, 10 ** 10))),
+                   'active' if expire > now else 'expired', f'/sub/{user_id}')
+
+    steps: Tuple[Tuple[str, str, Callable[[], Iterator[Tuple]], int], ...] = (
+        ('users', 'INSERT OR REPLACE INTO users (user_id, username, expire, trial, blocked) VALUES (?, ?, ?, ?, ?)',
+         user_rows, users),
+        ('payments', 'INSERT OR REPLACE INTO payments (payment_id, user_id, amount, date, status, payment_yoo_id) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', payment_rows, payments),
+        ('referrals', 'INSERT OR IGNORE INTO referrals (referrer_user_id, referral_user_id, used) VALUES (?, ?, ?)',
+         referral_rows, int(users * referral_share)),
+        ('panel_users', 'INSERT OR REPLACE INTO panel_users (username, expire, used_traffic, status, subscription_url) '
+                        'VALUES (?, ?, ?, ?, ?)', panel_rows, users),
+    )
+    for table, sql, rows, total in steps:
+        _fill(conn, table, sql, rows(), total, batch_size)
+
+    print("ANALYZE...")
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+
+
+async def create_schema(path: str) -> None:
+    os.environ['DB_PATH'] = path
+    from app.database import init_db, close_db
+    await init_db()
+    await close_db()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Синтетическая база бота для бенчмарков")
+    parser.add_argument("path", help="файл базы (будет перезаписан)")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--payments", type=int, default=500000)
+    parser.add_argument("--referral-share", type=float, default=0.2, help="доля пришедших по реферальной ссылке")
+    parser.add_argument("--blocked-share", type=float, default=0.05, help="доля заблокировавших бота")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for suffix in ('', '-wal', '-shm'):
+        Path(args.path + suffix).unlink(missing_ok=True)
+    asyncio.run(create_schema(args.path))
+    generate(args.path, args.users, args.payments, args.referral_share, args.blocked_share,
+             args.batch_size, args.seed)
+    print(f"Готово: {args.path} ({Path(args.path).stat().st_size / 2 ** 20:.0f} МБ)")
+
+
+if __name__ == '__main__':
+    main()
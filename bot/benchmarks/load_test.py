@@ -0,0 +1,288 @@
+"""
+Нагрузочный тест бота целиком: рабочий диспетчер с middleware (app/dispatcher.py), заглушки Bot API,
+Marzban и YooKassa на локальных портах.
+
+Сценарии пользователей (навигация по меню, пробный период, покупка, приход по реферальной
+ссылке) запускаются с нарастающей частотой. Для каждой ступени выводятся пропускная
+способность и p50/p95/p99 по обработчикам; --json сохраняет отчёт для сравнения с базовым.
+
+    python benchmarks/load_test.py --rates 10,25,50 --duration 10 --panel-latency 0.05
+    python benchmarks/load_test.py --json after.json --baseline before.json
+    python benchmarks/load_test.py --panels 3  # несколько заглушек Marzban, новые пользователи распределяются между ними
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# Порты заглушек и настройки бота задаются до импорта config
+BOT_API_PORT, MARZBAN_PORT, YOOKASSA_PORT = 18601, 18602, 18603
+_pre_parser = argparse.ArgumentParser(add_help=False)
+_pre_parser.add_argument('--panels', type=int, default=1)
+PANEL_PORTS = [MARZBAN_PORT + 10 * i for i in range(max(_pre_parser.parse_known_args()[0].panels, 1))]
+_workdir = tempfile.mkdtemp(prefix='bot-load-')
+for key, value in {
+    'BOT_TOKEN': '123456:' + 'A' * 35,
+    'ADMIN_TELEGRAM_ID': '1',
+    'MARZBAN_PANELS': json.dumps([{'name': f'stub{i}', 'url': f'http://127.0.0.1:{port}', 'username': 'admin',
+                                   'password': 'admin', 'capacity': 100000} for i, port in enumerate(PANEL_PORTS)]),
+    'YOOKASSA_ID': '1',
+    'YOOKASSA_SECRET_KEY': 'test',
+    'TELETYPE_INSTRUCTION': 'https://example.com/instruction',
+    'TELEGRAPH_TERMS': 'https://example.com/terms',
+    'VPN_CONNECT_TEMPLATE': 'https://example.com/?url={}',
+    'DB_PATH': os.path.join(_workdir, 'subscriptions.sqlite'),
+    'TELEGRAM_API_URL': f'http://127.0.0.1:{BOT_API_PORT}',
+}.items():
+    os.environ[key] = value
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.utils.deep_linking import encode_payload
+from yookassa import Configuration
+
+from app.context import create_context
+from app.database import init_db
+from app.dispatcher import build_dispatcher
+from app.handlers import drain_background_tasks
+from benchmarks.stubs import MarzbanStub, YooKassaStub, serve
+from tools.fake_telegram import FakeBotAPI, message_update, callback_update
+
+# Пользователи с действующей подпиской в заглушке панели (экраны ключа и подключения)
+SUBSCRIBERS = 5000
+FIRST_NEW_USER = 1_000_000
+
+Scenario = Callable[['LoadTest', int], Awaitable[None]]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по методу ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))]
+
+
+class HandlerTimer(BaseMiddleware):
+    """Запоминает время каждого обработчика по имени."""
+
+    def __init__(self, samples: Dict[str, List[float]]):
+        self.samples = samples
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples[name].append(time.perf_counter() - start)
+
+
+class LoadTest:
+    def __init__(self, bot: Bot, dp: Dispatcher, yookassa: YooKassaStub):
+        self.bot = bot
+        self.dp = dp
+        self.yookassa = yookassa
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.updates = 0
+        self.errors: Dict[str, int] = defaultdict(int)
+        self._new_users = iter(range(FIRST_NEW_USER, 10 ** 12))
+
+    def new_user(self) -> int:
+        return next(self._new_users)
+
+    async def send(self, update: dict) -> None:
+        """Передаёт обновление диспетчеру так же, как это делает вебхук."""
+        self.updates += 1
+        try:
+            await self.dp.feed_update(self.bot, Update.model_validate(update, context={'bot': self.bot}))
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+
+    async def message(self, user_id: int, text: str) -> None:
+        await self.send(message_update(user_id, text))
+
+    async def press(self, user_id: int, data: str) -> None:
+        await self.send(callback_update(user_id, data))
+
+
+# --- Сценарии --- #
+
+async def navigation(test: LoadTest, _: int) -> None:
+    """Подписчик открывает меню, ключ и инструкцию подключения."""
+    user_id = random.randint(1, SUBSCRIBERS)
+    await test.message(user_id, '/start')
+    for data in ('key', random.choice(('connect_android', 'connect_ios')), 'main_menu', 'ref', 'my_referrals', 'main_menu'):
+        await test.press(user_id, data)
+
+
+async def trial(test: LoadTest, user_id: int) -> None:
+    """Новый пользователь берёт пробный период и смотрит ключ."""
+    await test.message(user_id, '/start')
+    await test.press(user_id, 'trial_5_days')
+    await test.press(user_id, 'key')
+
+
+async def purchase(test: LoadTest, user_id: int) -> None:
+    """Пользователь выбирает тариф, оплачивает и проверяет платёж (иногда дважды)."""
+    await test.message(user_id, '/start')
+    await test.press(user_id, 'sub')
+    await test.press(user_id, 'sub_1')
+    payments = test.yookassa.by_user.get(str(user_id))
+    if not payments:
+        return
+    presses = 2 if random.random() < 0.3 else 1
+    await asyncio.gather(*(test.press(user_id, f'check_payment_{payments[-1]}_1') for _ in range(presses)))
+    await test.press(user_id, 'key')
+
+
+async def referral(test: LoadTest, user_id: int) -> None:
+    """Приглашённый другом пользователь приходит по ссылке и покупает подписку."""
+    referrer = random.randint(1, SUBSCRIBERS)
+    await test.message(user_id, f'/start {encode_payload(str(referrer))}')
+    await purchase(test, user_id)
+
+
+SCENARIOS: Dict[str, Scenario] = {'navigation': navigation, 'trial': trial, 'purchase': purchase, 'referral': referral}
+DEFAULT_MIX = 'navigation=60,trial=15,purchase=15,referral=10'
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise SystemExit(f"Неизвестный сценарий: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+async def run_stage(test: LoadTest, rate: float, duration: float, mix: Dict[str, float]) -> dict:
+    """Запускает сценарии с частотой rate в секунду в течение duration и ждёт их завершения."""
+    test.samples.clear()
+    test.errors.clear()
+    test.updates = 0
+    names, weights = list(mix), list(mix.values())
+    sessions: List[asyncio.Task] = []
+
+    start = time.perf_counter()
+    for i in range(int(rate * duration)):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        scenario = SCENARIOS[random.choices(names, weights)[0]]
+        sessions.append(asyncio.create_task(scenario(test, test.new_user())))
+    await asyncio.gather(*sessions)
+    await drain_background_tasks()
+    elapsed = time.perf_counter() - start
+
+    handlers = {
+        name: {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'max': max(values),
+        }
+        for name, values in sorted(test.samples.items())
+    }
+    return {
+        'rate': rate,
+        'sessions': len(sessions),
+        'updates': test.updates,
+        'elapsed': elapsed,
+        'throughput': test.updates / elapsed if elapsed else 0.0,
+        'errors': dict(test.errors),
+        'handlers': handlers,
+    }
+
+
+def print_stage(stage: dict, baseline: Optional[dict] = None) -> None:
+    print(f"\n=== {stage['rate']:g} сценариев/с: {stage['sessions']} сценариев, {stage['updates']} обновлений "
+          f"за {stage['elapsed']:.1f} с, {stage['throughput']:.1f} обновлений/с, ошибки: {stage['errors'] or 'нет'}")
+    print(f"{'обработчик':<28}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, row in stage['handlers'].items():
+        line = (f"{name:<28}{row['count']:>8}{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}"
+                f"{row['p99'] * 1000:>10.1f}{row['max'] * 1000:>10.1f}")
+        before = (baseline or {}).get('handlers', {}).get(name)
+        if before and before['p95']:
+            line += f"   p95 {(row['p95'] / before['p95'] - 1) * 100:+.0f}% к базовому"
+        print(line)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных заглушках")
+    parser.add_argument("--rates", default="5,10,25,50", help="частоты запуска сценариев в секунду по ступеням")
+    parser.add_argument("--duration", type=float, default=10, help="длительность ступени, сек.")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса сценариев: имя=вес,...")
+    parser.add_argument("--panel-latency", type=float, default=0.03, help="задержка ответа Marzban, сек.")
+    parser.add_argument("--gateway-latency", type=float, default=0.1, help="задержка ответа YooKassa, сек.")
+    parser.add_argument("--panels", type=int, default=1, help="число заглушек панелей Marzban")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчёт в файл")
+    parser.add_argument("--baseline", help="отчёт предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, force=True)
+    random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    baseline = {stage['rate']: stage for stage in json.loads(Path(args.baseline).read_text())['stages']} \
+        if args.baseline else {}
+
+    telegram = FakeBotAPI()
+    # Подписчики поровну разложены по панелям, новые пользователи распределяются ботом
+    stubs = [MarzbanStub(latency=args.panel_latency, jitter=args.panel_latency / 3) for _ in PANEL_PORTS]
+    chunk = -(-SUBSCRIBERS // len(stubs))
+    for i, stub in enumerate(stubs):
+        stub.seed(min(chunk, SUBSCRIBERS - i * chunk), first_id=i * chunk + 1)
+    yookassa = YooKassaStub(latency=args.gateway_latency, jitter=args.gateway_latency / 3)
+    runners = [
+        await serve(telegram.app(), BOT_API_PORT),
+        await serve(yookassa.app(), YOOKASSA_PORT),
+    ] + [await serve(stub.app(), port) for stub, port in zip(stubs, PANEL_PORTS)]
+    Configuration.api_url = f'http://127.0.0.1:{YOOKASSA_PORT}/v3'
+
+    ctx = create_context()
+    bot = ctx.bot
+    dp = build_dispatcher(ctx)
+    test = LoadTest(bot, dp, yookassa)
+    timer = HandlerTimer(test.samples)
+    dp.message.middleware(timer)
+    dp.callback_query.middleware(timer)
+
+    await init_db()
+    stages = []
+    try:
+        for rate in (float(r) for r in args.rates.split(',')):
+            stage = await run_stage(test, rate, args.duration, mix)
+            print_stage(stage, baseline.get(rate))
+            stages.append(stage)
+    finally:
+        await ctx.close()
+        for runner in runners:
+            await runner.cleanup()
+        shutil.rmtree(_workdir, ignore_errors=True)
+
+    for i, stub in enumerate(stubs):
+        print(f"\nMarzban stub{i}: пользователей {len(stub.users)}, вызовы {dict(stub.calls)}", end='')
+    print(f"\nYooKassa: {dict(yookassa.calls)}, Bot API: {len(telegram.calls)}")
+    if args.json:
+        report = {'args': vars(args), 'stages': stages}
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"Отчёт сохранён в {args.json}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,148 @@
+"""
+Локальные заглушки внешних сервисов для нагрузочных тестов: Marzban и YooKassa.
+Задержка ответа настраивается, чтобы моделировать удалённую панель и платёжный шлюз.
+"""
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List
+
+from aiohttp import web
+
+
+async def _delay(latency: float, jitter: float) -> None:
+    if latency or jitter:
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+
+class MarzbanStub:
+    """Заглушка API Marzban: токен, пользователи, создание и изменение пользователей."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.users: Dict[str, dict] = {}
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def seed(self, count: int, first_id: int = 1) -> None:
+        """Создаёт count пользователей с действующей подпиской."""
+        now = int(time.time())
+        for user_id in range(first_id, first_id + count):
+            self._put(str(user_id), now + random.randint(-5, 60) * 86400)
+
+    def _put(self, username: str, expire: int) -> dict:
+        user = {
+            "username": username, "expire": expire, "status": "active", "used_traffic": 0,
+            "proxies": {"vless": {"flow": "xtls-rprx-vision"}}, "inbounds": {}, "links": [],
+            "data_limit_reset_strategy": "no_reset", "subscription_url": f"/sub/{username}",
+        }
+        self.users[username] = user
+        return user
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/api/admin/token', self.token)
+        app.router.add_get('/api/users', self.get_users)
+        app.router.add_get('/api/user/{username}', self.get_user)
+        app.router.add_post('/api/user', self.add_user)
+        app.router.add_put('/api/user/{username}', self.modify_user)
+        return app
+
+    async def token(self, request: web.Request) -> web.Response:
+        self.calls['token'] += 1
+        await _delay(self.latency, self.jitter)
+        payload = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time()) + 86400}).encode()).decode().rstrip('=')
+        return web.json_response({"access_token": f"stub.{payload}.sig", "token_type": "bearer"})
+
+    async def get_users(self, request: web.Request) -> web.Response:
+        self.calls['get_users'] += 1
+        await _delay(self.latency, self.jitter)
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', len(self.users) or 1))
+        names = sorted(self.users)
+        return web.json_response({"users": [self.users[n] for n in names[offset:offset + limit]], "total": len(names)})
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        self.calls['get_user'] += 1
+        await _delay(self.latency, self.jitter)
+        user = self.users.get(request.match_info['username'])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(user)
+
+    async def add_user(self, request: web.Request) -> web.Response:
+        self.calls['add_user'] += 1
+        await _delay(self.latency, self.jitter)
+        body = await request.json()
+        if body['username'] in self.users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        return web.json_response(self._put(body['username'], body.get('expire') or 0))
+
+    async def modify_user(self, request: web.Request) -> web.Response:
+        self.calls['modify_user'] += 1
+        await _delay(self.latency, self.jitter)
+        user = self.users.get(request.match_info['username'])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        body = await request.json()
+        if body.get('expire') is not None:
+            user['expire'] = body['expire']
+        return web.json_response(user)
+
+
+class YooKassaStub:
+    """
+    Заглушка API YooKassa (/v3/payments). Созданный платёж сразу считается оплаченным
+    при следующей проверке. Бот направляется на неё через Configuration.api_url.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.payments: Dict[str, dict] = {}
+        self.by_user: Dict[str, List[str]] = defaultdict(list)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v3/payments', self.create)
+        app.router.add_get('/v3/payments/{payment_id}', self.find_one)
+        return app
+
+    async def create(self, request: web.Request) -> web.Response:
+        self.calls['create'] += 1
+        await _delay(self.latency, self.jitter)
+        body = await request.json()
+        payment_id = uuid.uuid4().hex
+        payment = {
+            "id": payment_id, "status": "pending", "paid": False, "test": True, "refundable": False,
+            "amount": body["amount"], "metadata": body.get("metadata", {}),
+            "description": body.get("description"),
+            "created_at": time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yookassa.stub/pay/{payment_id}"},
+            "recipient": {"account_id": "1", "gateway_id": "1"},
+        }
+        self.payments[payment_id] = payment
+        self.by_user[str(payment["metadata"].get("user_id"))].append(payment_id)
+        return web.json_response(payment)
+
+    async def find_one(self, request: web.Request) -> web.Response:
+        self.calls['find_one'] += 1
+        await _delay(self.latency, self.jitter)
+        payment = self.payments.get(request.match_info['payment_id'])
+        if payment is None:
+            return web.json_response({"type": "error", "code": "not_found", "description": "not found"}, status=404)
+        payment.update(status="succeeded", paid=True)
+        return web.json_response(payment)
+
+
+async def serve(app: web.Application, port: int, host: str = '127.0.0.1') -> web.AppRunner:
+    """Запускает приложение-заглушку и возвращает runner для остановки."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -9,18 +10,145 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 MARZBAN_URL = os.getenv('MARZBAN_URL')
 MARZBAN_USERNAME = os.getenv('MARZBAN_USERNAME')
 MARZBAN_PASSWORD = os.getenv('MARZBAN_PASSWORD')
+MARZBAN_TIMEOUT = float(os.getenv("MARZBAN_TIMEOUT", 10))                # таймаут запроса (сек.)
+MARZBAN_MAX_CONNECTIONS = int(os.getenv("MARZBAN_MAX_CONNECTIONS", 20))   # соединений в пуле
+MARZBAN_KEEPALIVE = float(os.getenv("MARZBAN_KEEPALIVE", 60))            # сколько держать простаивающее соединение (сек.)
+# Несколько панелей Marzban: JSON-список
+# [{"name": "nl1", "url": "https://...", "username": "...", "password": "...", "capacity": 1000}, ...].
+# Новые пользователи заводятся на наименее загруженной панели (доля от capacity).
+# Без MARZBAN_PANELS используется одна панель из MARZBAN_URL / MARZBAN_USERNAME / MARZBAN_PASSWORD
+MARZBAN_CAPACITY = int(os.getenv("MARZBAN_CAPACITY", 1000))  # пользователей на панель, если capacity не задан
+MARZBAN_PANELS = json.loads(os.getenv("MARZBAN_PANELS") or '[]') or [
+    {'name': 'main', 'url': MARZBAN_URL, 'username': MARZBAN_USERNAME, 'password': MARZBAN_PASSWORD}
+]
+# Защита от медленной или упавшей панели (для каждой панели отдельно)
+MARZBAN_DEADLINE = float(os.getenv("MARZBAN_DEADLINE", 15))               # предел на весь вызов, включая логин (сек.)
+MARZBAN_RETRIES = int(os.getenv("MARZBAN_RETRIES", 3))                    # попыток для читающих запросов
+MARZBAN_RETRY_DELAY = float(os.getenv("MARZBAN_RETRY_DELAY", 0.3))        # базовая пауза между попытками (сек.)
+MARZBAN_CONCURRENCY = int(os.getenv("MARZBAN_CONCURRENCY", MARZBAN_MAX_CONNECTIONS))  # запросов одновременно
+MARZBAN_QUEUE_TIMEOUT = float(os.getenv("MARZBAN_QUEUE_TIMEOUT", 2))      # ожидание свободного слота (сек.)
+MARZBAN_RESERVED = int(os.getenv("MARZBAN_RESERVED", max(MARZBAN_CONCURRENCY // 4, 1)))  # слотов только для оплаты и активации
+MARZBAN_BREAKER_FAILURES = int(os.getenv("MARZBAN_BREAKER_FAILURES", 5))  # ошибок подряд до отключения
+MARZBAN_BREAKER_RECOVERY = float(os.getenv("MARZBAN_BREAKER_RECOVERY", 30))  # пауза до пробного запроса (сек.)
 
 YOOKASSA_ID = os.getenv("YOOKASSA_ID")
 YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
+YOOKASSA_MAX_WORKERS = int(os.getenv("YOOKASSA_MAX_WORKERS", 8))  # потоков для запросов к SDK
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", 15))       # таймаут чтения ответа (сек.)
+YOOKASSA_CONNECT_TIMEOUT = float(os.getenv("YOOKASSA_CONNECT_TIMEOUT", 5))  # таймаут соединения (сек.)
+YOOKASSA_RETRIES = int(os.getenv("YOOKASSA_RETRIES", 3))          # попыток на запрос
+
+# Режим получения обновлений Telegram: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")            # публичный https-адрес бота
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")                # проверка заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))      # процессов на одном порту (SO_REUSEPORT)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")            # свой Bot API сервер или локальная заглушка
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")        # memory или sqlite (общий для всех воркеров)
+# Блокировки активации пользователя: memory (один процесс) или sqlite (общие для всех воркеров)
+LOCK_BACKEND = os.getenv("LOCK_BACKEND", "sqlite" if WEBHOOK_WORKERS > 1 else "memory")
+
+# Вебхук уведомлений YooKassa (0 — выключен, подписка активируется только кнопкой)
+YOOKASSA_WEBHOOK_PORT = int(os.getenv("YOOKASSA_WEBHOOK_PORT", 0))
+YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+# Проверять IP отправителя и статус платежа через API (выключать только для локальных тестов)
+YOOKASSA_WEBHOOK_STRICT = os.getenv("YOOKASSA_WEBHOOK_STRICT", "1") == "1"
+# Брать IP клиента из X-Forwarded-For (если бот стоит за обратным прокси)
+YOOKASSA_WEBHOOK_TRUST_PROXY = int(os.getenv("YOOKASSA_WEBHOOK_TRUST_PROXY", 0))  # число доверенных прокси перед ботом
 
 TELETYPE_INSTRUCTION = os.getenv("TELETYPE_INSTRUCTION")
 TELEGRAPH_TERMS = os.getenv("TELEGRAPH_TERMS")
 VPN_CONNECT_TEMPLATE = os.getenv("VPN_CONNECT_TEMPLATE")
 
+# Зеркало пользователей Marzban в SQLite
+PANEL_SYNC_INTERVAL = int(os.getenv("PANEL_SYNC_INTERVAL", 15))        # минут между синхронизациями
+PANEL_SYNC_PAGE_SIZE = int(os.getenv("PANEL_SYNC_PAGE_SIZE", 500))     # пользователей на страницу
+PANEL_SYNC_CONCURRENCY = int(os.getenv("PANEL_SYNC_CONCURRENCY", 4))   # страниц параллельно
+
+# Сверка таблицы users с панелями Marzban
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", 6))             # часов между сверками (0 — выключена)
+RECONCILE_REPAIR = os.getenv("RECONCILE_REPAIR", "0") == "1"             # исправлять локальную базу по панели
+RECONCILE_BATCH = int(os.getenv("RECONCILE_BATCH", 1000))                # строк базы на страницу и на транзакцию
+
+# Кэш информации о подписке пользователя (ключ, срок) для экранов подключения
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))  # сек.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+
+# Рассылки (лимит Telegram — около 30 сообщений в секунду на бота)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 10))
+
+# Антифлуд для кнопок: у пользователя до THROTTLE_BURST жетонов, пополнение THROTTLE_RATE в секунду
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", 1))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", 10))
+
+# Метрики Prometheus на /metrics (0 — выключены). В режиме вебхука воркер N слушает METRICS_PORT + N
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# База данных
+DB_PATH = os.getenv("DB_PATH", "/bot/database/subscriptions.sqlite")
+DB_READERS = int(os.getenv("DB_READERS", 3))  # соединений на чтение в пуле
+
+# QR-коды ссылок подписки (нужен пакет qrcode[pil]; без него кнопка не показывается)
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR", "/bot/database/qr")
+QR_CACHE_MAX_MB = int(os.getenv("QR_CACHE_MAX_MB", 50))  # предел размера кэша картинок на диске
+
+# Резервные копии базы (онлайн, без остановки бота)
+BACKUP_DIR = os.getenv("BACKUP_DIR", "/bot/database/backups")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", 24))                         # часов между полными копиями (0 — выключены)
+BACKUP_INCREMENTAL_INTERVAL = int(os.getenv("BACKUP_INCREMENTAL_INTERVAL", 0))  # минут между инкрементами (0 — выключены)
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 7))                                  # сколько полных копий хранить
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", 256))                              # страниц базы за один шаг копирования
+BACKUP_SLEEP = float(os.getenv("BACKUP_SLEEP", 0.01))                           # пауза между шагами, сек.
+
+REFERRAL_BONUS_DAYS = 7  # дней подписки рефереру и приглашённому при первой покупке
+
 prices = {1: 99, # мес.: цена
           3: 299,
           6: 599}
 
+# Стоимость нажатия кнопки в жетонах антифлуда по префиксу callback_data (остальные — 1).
+# Дороже кнопки, которые обращаются к Marzban или YooKassa
+throttle_costs = {'key': 2,
+                  'connect_android': 2,
+                  'connect_ios': 2,
+                  'trial_': 3,
+                  'sub_': 3,
+                  'check_payment_': 3}
+
+# Планировщик обновлений: класс приоритета -> (обработчиков одновременно, длина очереди).
+# Порядок — по убыванию приоритета; классы из scheduler_shed при перегрузке сразу получают отказ
+scheduler_classes = {'payment': (32, 1000),
+                     'activation': (16, 500),
+                     'key': (16, 200),
+                     'navigation': (32, 200)}
+scheduler_shed = ('key', 'navigation')
+# Сколько классы не из scheduler_shed (оплата, активация) ждут свободный обработчик, прежде чем получить отказ (сек.)
+SCHEDULER_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", 30))
+# Класс нажатия по префиксу callback_data (остальные нажатия и сообщения — navigation)
+scheduler_routes = {'check_payment_': 'payment',
+                    'sub_': 'payment',
+                    'trial_': 'activation',
+                    'key': 'key',
+                    'connect_': 'key'}
+
+# Напоминания об окончании подписки: этап -> (за сколько секунд до истечения, текст).
+# Этап с 0 отправляется после истечения, не позже REMINDER_EXPIRED_WINDOW секунд.
+reminder_stages = {
+    '3d': (3 * 86400, '⏳ <b>Ваша подписка истекает через 3 дня.</b>\n\n'
+                      'Продлите её заранее, чтобы избежать отключения.'),
+    '1d': (86400, '⚠️ <b>Ваша подписка истекает завтра!</b>\n\n'
+                  'Продлите её заранее, чтобы избежать отключения.'),
+    'expired': (0, '❌ <b>Ваша подписка истекла.</b>\n\n'
+                   'Нажмите /start, чтобы продлить её.'),
+}
+REMINDER_EXPIRED_WINDOW = 86400
+REMINDER_HOURS = os.getenv("REMINDER_HOURS", "10-21")  # часы запуска (формат cron)
+
 # Основные тексты
 main_text = (
     '❄️ ArcticVPN - Сервис для бесперебойного доступа в Интернет.\n\n'
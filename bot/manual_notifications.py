@@ -1,47 +1,33 @@
 import asyncio
 from datetime import datetime
-from typing import List
-from run import bot
-from marzban import MarzbanAPI
-from app.database import get_all_users
-from config import MARZBAN_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD, ADMIN_TELEGRAM_ID
-from aiogram.enums import ParseMode
+from typing import List, Optional
+from app.context import create_context
+from app.database import init_db, get_all_users, get_inactive_panel_users
+from app.panel_sync import sync_panel_users
+from app.broadcast import broadcast
+from config import ADMIN_TELEGRAM_ID
 
-api = MarzbanAPI(base_url=MARZBAN_URL)
+# Только бот, клиент панели и база — без диспетчера, планировщика и серверов из run.py
+ctx = create_context()
 
 
 async def get_inactive_users() -> List[str]:
-    """Получает список пользователей, которые не использовали трафик и у которых активная подписка."""
-    inactive_users = []
-    users = await get_all_users()
-    token = await api.get_token(username=MARZBAN_USERNAME, password=MARZBAN_PASSWORD)
-    current_timestamp = int(datetime.now().timestamp())
-
-    for user_id in users:
-        user = await api.get_user(username=user_id, token=token.access_token)
-        if user.used_traffic == 0 and user.expire > current_timestamp:
-            inactive_users.append(user.username)
-
-    return inactive_users
-
-
-async def safe_send_message(user_id: str, message: str):
-    """Отправляет сообщение пользователю и обрабатывает возможные ошибки."""
-    try:
-        await bot.send_message(
-            chat_id=user_id,
-            text=message,
-            parse_mode=ParseMode.HTML
-        )
-        print(f"✅ Отправлено: {user_id}")
-    except Exception as e:
-        print(f"❌ Ошибка при отправке уведомления {user_id}: {e}")
+    """
+    Получает список пользователей, которые не использовали трафик и у которых активная подписка.
+    Сначала обновляет зеркало Marzban пакетной синхронизацией, затем выбирает пользователей одним запросом.
+    """
+    await sync_panel_users()
+    return await get_inactive_panel_users(int(datetime.now().timestamp()))
 
 
-async def send_messages_to_users(user_ids: List[str], message: str):
-    """Отправляет сообщение списку пользователей."""
-    for user_id in user_ids:
-        await safe_send_message(user_id, message)
+async def send_messages_to_users(user_ids: List[str], message: str, broadcast_id: Optional[str] = None):
+    """
+    Отправляет сообщение списку пользователей с ограничением частоты и выводит отчёт.
+    Прерванная рассылка того же текста продолжится с места остановки;
+    чтобы отправить тот же текст заново, передайте новый broadcast_id.
+    """
+    report = await broadcast(ctx.bot, user_ids, message, broadcast_id)
+    print(report)
 
 
 async def send_message_to_inactive_users(message: str):
@@ -53,7 +39,7 @@ async def send_message_to_inactive_users(message: str):
 
 async def send_message_to_all_users(message: str):
     """Отправляет сообщение всем пользователям."""
-    users = await get_all_users()
+    users = await get_all_users(exclude_blocked=True)
     users.append(ADMIN_TELEGRAM_ID)
     await send_messages_to_users(users, message)
 
@@ -75,9 +61,14 @@ async def main():
         '👷 @id'
     )
 
-    # Выбрать нужное:
-    # await send_message_to_all_users(message_all)
-    # await send_message_to_inactive_users(message_inactive)
+    await init_db()
+    try:
+        # Выбрать нужное:
+        # await send_message_to_all_users(message_all)
+        # await send_message_to_inactive_users(message_inactive)
+        pass
+    finally:
+        await ctx.close()
 
 
 if __name__ == '__main__':
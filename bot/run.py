@@ -1,78 +1,199 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
+import multiprocessing
+import signal
+import time
+from datetime import datetime
 
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from marzban import MarzbanAPI
-from app.database import init_db
-from app.handlers import router
-from config import BOT_TOKEN, MARZBAN_URL, MARZBAN_PASSWORD, MARZBAN_USERNAME
+from app.backup import scheduled_backup, scheduled_incremental
+from app.context import create_context
+from app.database import init_db, close_db, purge_kv_cache
+from app.dispatcher import build_dispatcher
+from app.handlers import drain_background_tasks
+from app.leader import Leadership
+from app.metrics import start_metrics_server
+from app.panel_sync import sync_panel_users
+from app.reconcile import scheduled_reconcile
+from app.reminders import send_reminders
+from app.webhook import start_webhook_server, setup_webhook_routes
+from config import (
+    PANEL_SYNC_INTERVAL, REMINDER_HOURS, BOT_MODE, METRICS_HOST, METRICS_PORT,
+    BACKUP_INTERVAL, BACKUP_INCREMENTAL_INTERVAL, RECONCILE_INTERVAL,
+    WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_WORKERS
+)
 
 
-# Инициализация API и бота
-api = MarzbanAPI(base_url=MARZBAN_URL)
-bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
+# Инициализация бота: общий контекст (бот, клиент Marzban, база) доступен обработчикам как ctx
+ctx = create_context()
+bot = ctx.bot
+dp = build_dispatcher(ctx)
+
+# Задачи планировщика выполняет только один процесс, даже если воркеров несколько
+leadership = Leadership('scheduler')
+
+
+def leader_only(job):
+    async def wrapper():
+        if leadership.is_leader:
+            await job()
+    wrapper.__name__ = job.__name__
+    return wrapper
 
 
 async def send_expiry_notifications():
     """
-    Проверяет, у кого подписка истекает завтра,
-    и отправляет предупреждающее сообщение.
+    Отправляет напоминания об окончании подписки по этапам из config.reminder_stages.
+    Повторный запуск безопасен: уже отправленные напоминания не дублируются.
     """
-    token = await api.get_token(username=MARZBAN_USERNAME, password=MARZBAN_PASSWORD)
-    users_response = await api.get_users(token=token.access_token)
-    users = users_response.users
-
-    tomorrow = (datetime.now() + timedelta(days=1)).date()
-
-    for user in users:
-        expire_timestamp = user.expire
-        if not expire_timestamp:
-            continue
-
-        expire_date = datetime.fromtimestamp(expire_timestamp).date()
-        if expire_date == tomorrow:
-            try:
-                await bot.send_message(
-                    chat_id=user.username,
-                    text="⚠️ <b>Ваша подписка истекает завтра!</b>\n\n"
-                         "Продлите её заранее, чтобы избежать отключения."
-                )
-                logging.info(f"Уведомление отправлено: {user.username}")
-            except Exception as e:
-                logging.warning(f"Ошибка при отправке {user.username}: {e}")
+    await send_reminders(bot)
+
+
+async def purge_cache():
+    await purge_kv_cache(time.time())
 
 
 async def start_scheduler():
     """
     Запускает планировщик задач:
-    - уведомления об истечении подписки в 12:00 каждый день
+    - напоминания об истечении подписки каждый час в дневное время
+    - синхронизация зеркала пользователей Marzban (сразу и далее по интервалу)
+    - очистка устаревших записей общего кэша
+    - резервные копии базы (полные и инкрементальные, если включены)
+    - сверка таблицы users с панелями Marzban
     """
+    await leadership.start()
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(send_expiry_notifications, "cron", hour=12, minute=0)
+    scheduler.add_job(leader_only(send_expiry_notifications), "cron", hour=REMINDER_HOURS, minute=5,
+                      max_instances=1, coalesce=True)
+    scheduler.add_job(leader_only(sync_panel_users), "interval", minutes=PANEL_SYNC_INTERVAL,
+                      next_run_time=datetime.now(), max_instances=1, coalesce=True)
+    scheduler.add_job(leader_only(purge_cache), "interval", hours=1)
+    if RECONCILE_INTERVAL:
+        scheduler.add_job(leader_only(scheduled_reconcile), "interval", hours=RECONCILE_INTERVAL,
+                          max_instances=1, coalesce=True)
+    if BACKUP_INTERVAL:
+        scheduler.add_job(leader_only(scheduled_backup), "interval", hours=1,
+                          next_run_time=datetime.now(), max_instances=1, coalesce=True)
+    if BACKUP_INCREMENTAL_INTERVAL:
+        scheduler.add_job(leader_only(scheduled_incremental), "interval", minutes=BACKUP_INCREMENTAL_INTERVAL,
+                          max_instances=1, coalesce=True)
     scheduler.start()
     logging.info("Планировщик запущен")
+    return scheduler
+
+
+async def shutdown(scheduler: AsyncIOScheduler):
+    scheduler.shutdown(wait=False)
+    await drain_background_tasks()
+    await leadership.stop()
+    await ctx.close()
 
 
-async def main():
+async def run_polling():
     """
-    Точка входа:
+    Режим long polling (один процесс):
     - инициализация базы
     - запуск планировщика
+    - запуск вебхука YooKassa и метрик (если включены)
     - запуск Telegram-бота
+    - закрытие соединений при остановке
+    """
+    await init_db()
+    scheduler = await start_scheduler()
+    webhook_runner = await start_webhook_server(ctx)
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    try:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        for runner in (webhook_runner, metrics_runner):
+            if runner:
+                await runner.cleanup()
+        await shutdown(scheduler)
+
+
+async def set_telegram_webhook():
+    """Регистрирует вебхук в Telegram (один раз, до запуска воркеров)."""
+    await init_db()
+    try:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"Вебхук Telegram установлен: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+    finally:
+        await close_db()
+        await bot.session.close()
+
+
+async def run_webhook(worker: int = 0):
+    """
+    Режим вебхука: aiohttp-сервер принимает обновления Telegram и уведомления YooKassa.
+    Несколько воркеров слушают один порт через SO_REUSEPORT, задачи планировщика
+    выполняет только ведущий процесс.
     """
     await init_db()
-    dp.include_router(router)
-    await start_scheduler()
-    await dp.start_polling(bot)
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_webhook_routes(app, ctx)
+    setup_application(app, dp, bot=bot)
+
+    scheduler = await start_scheduler()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1).start()
+    logging.info(f"Воркер {worker} принимает вебхуки на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    # У каждого воркера свои метрики, поэтому и свой порт
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT and METRICS_PORT + worker)
+
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await shutdown(scheduler)
+
+
+def _webhook_worker(worker: int):
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s | w{worker} | %(levelname)s | %(message)s",
+                        force=True)
+    try:
+        asyncio.run(run_webhook(worker))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    if BOT_MODE != 'webhook':
+        asyncio.run(run_polling())
+        return
+
+    asyncio.run(set_telegram_webhook())
+    if WEBHOOK_WORKERS <= 1:
+        asyncio.run(run_webhook())
+        return
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=_webhook_worker, args=(i,), name=f'bot-worker-{i}')
+               for i in range(WEBHOOK_WORKERS)]
+    for process in workers:
+        process.start()
+    signal.signal(signal.SIGTERM, lambda *_: [process.terminate() for process in workers])
+    for process in workers:
+        process.join()
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
     try:
-        asyncio.run(main())
+        main()
     except KeyboardInterrupt:
         logging.info("Остановка приложения пользователем")
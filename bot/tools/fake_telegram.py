@@ -0,0 +1,163 @@
+"""
+Локальная замена Telegram для проверки режима вебхука без сети.
+
+Поднимает заглушку Bot API (бот запускается с TELEGRAM_API_URL, указывающим на неё)
+и отправляет боту обновления в вебхук от имени нескольких пользователей,
+дожидаясь ответа бота на каждое.
+
+    BOT_MODE=webhook WEBHOOK_BASE_URL=http://127.0.0.1:8080 WEBHOOK_SECRET=secret \\
+    TELEGRAM_API_URL=http://127.0.0.1:8081 WEBHOOK_WORKERS=2 python run.py
+
+    python tools/fake_telegram.py --users 20 --secret secret
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import statistics
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import ClientSession, web
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def _message(chat_id: int, text: str, from_user: Optional[dict] = None) -> dict:
+    return {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": from_user or {"id": 1, "is_bot": True, "first_name": "bot", "username": "fake_bot"},
+        "text": text,
+    }
+
+
+def message_update(user_id: int, text: str) -> dict:
+    """Обновление с текстовым сообщением пользователя (например, /start)."""
+    message = _message(user_id, text, _user(user_id))
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    """Обновление с нажатием inline-кнопки."""
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "message": _message(user_id, "menu"),
+            "data": data,
+        },
+    }
+
+
+class FakeBotAPI:
+    """
+    Заглушка Bot API: отвечает успехом на любой метод и запоминает вызовы.
+    Ожидающие ответа пользователи получают уведомление о каждом вызове для их чата.
+    """
+
+    def __init__(self):
+        self.calls: List[dict] = []
+        self._waiters: Dict[str, List[asyncio.Future]] = defaultdict(list)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        payload = dict(await request.post()) if request.body_exists else {}
+        chat_id = str(payload.get('chat_id') or '')
+        self.calls.append({'method': method, 'chat_id': chat_id, 'time': time.perf_counter(), 'payload': payload})
+
+        if method == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "fake_bot"}
+        elif method in ('sendMessage', 'editMessageText', 'sendPhoto'):
+            result = _message(int(chat_id or 0), str(payload.get('text') or payload.get('caption') or ''))
+            if method == 'sendPhoto':
+                result["photo"] = [{"file_id": f"photo{result['message_id']}", "file_unique_id": "u",
+                                    "width": 100, "height": 100}]
+        else:
+            result = True
+
+        for future in self._waiters.pop(chat_id, []):
+            if not future.done():
+                future.set_result(method)
+        return web.json_response({"ok": True, "result": result})
+
+    async def wait_reply(self, chat_id: int, timeout: float = 10) -> str:
+        """Ждёт ближайший вызов Bot API для чата chat_id и возвращает имя метода."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[str(chat_id)].append(future)
+        return await asyncio.wait_for(future, timeout)
+
+
+async def send_update(session: ClientSession, url: str, update: dict, secret: Optional[str] = None) -> int:
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    async with session.post(url, data=json.dumps(update), headers={**headers, 'Content-Type': 'application/json'}) as response:
+        return response.status
+
+
+async def wait_ready(session: ClientSession, url: str, timeout: float = 30) -> None:
+    """Ждёт, пока бот начнёт принимать запросы на адресе вебхука."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(url):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Прогон сценария через заглушку Telegram")
+    parser.add_argument("--webhook", default="http://127.0.0.1:8080/telegram/webhook")
+    parser.add_argument("--secret")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=10)
+    args = parser.parse_args()
+
+    api = FakeBotAPI()
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.api_port).start()
+
+    scenario = [lambda u: message_update(u, '/start'), lambda u: callback_update(u, 'sub'),
+                lambda u: callback_update(u, 'ref'), lambda u: callback_update(u, 'main_menu')]
+    latencies: List[float] = []
+
+    async def user_session(session: ClientSession, user_id: int) -> None:
+        for make_update in scenario:
+            start = time.perf_counter()
+            reply = asyncio.ensure_future(api.wait_reply(user_id))
+            await send_update(session, args.webhook, make_update(user_id), args.secret)
+            await reply
+            latencies.append(time.perf_counter() - start)
+
+    async with ClientSession() as session:
+        await wait_ready(session, args.webhook)
+        await asyncio.gather(*(user_session(session, 100000 + i) for i in range(args.users)))
+    await runner.cleanup()
+
+    latencies.sort()
+    print(f"Обновлений: {len(latencies)}, вызовов Bot API: {len(api.calls)}")
+    print(f"p50 {statistics.median(latencies) * 1000:.1f} мс, "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} мс")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
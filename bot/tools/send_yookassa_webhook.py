@@ -0,0 +1,61 @@
+"""
+Локальная заглушка YooKassa: отправляет боту уведомление payment.succeeded.
+
+Бот должен быть запущен с YOOKASSA_WEBHOOK_PORT и YOOKASSA_WEBHOOK_STRICT=0
+(без проверки IP и статуса через API), а платёж — существовать в таблице payments.
+
+    python tools/send_yookassa_webhook.py <payment_yoo_id> <user_id> --period 1
+
+Бот сверяет сумму с записью платежа, поэтому по умолчанию берётся цена тарифа из config.prices;
+для платежа с другой суммой укажите --amount.
+"""
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+from aiohttp import ClientSession
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from config import prices
+
+
+def build_notification(payment_yoo_id: str, user_id: str, period: int, amount: float) -> dict:
+    """Тело уведомления в формате YooKassa."""
+    return {
+        "type": "notification",
+        "event": "payment.succeeded",
+        "object": {
+            "id": payment_yoo_id,
+            "status": "succeeded",
+            "paid": True,
+            "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
+            "metadata": {"user_id": str(user_id), "period": str(period)},
+            "description": f"Оплата подписки на {period} мес.",
+        },
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Отправка тестового уведомления YooKassa")
+    parser.add_argument("payment_yoo_id")
+    parser.add_argument("user_id")
+    parser.add_argument("--period", type=int, default=1)
+    parser.add_argument("--amount", type=float, help="сумма платежа, по умолчанию — цена тарифа --period")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/yookassa/webhook")
+    parser.add_argument("--repeat", type=int, default=1, help="сколько раз повторить (проверка идемпотентности)")
+    args = parser.parse_args()
+
+    amount = args.amount if args.amount is not None else prices.get(args.period)
+    if amount is None:
+        parser.error(f"нет тарифа на {args.period} мес., укажите --amount")
+    body = build_notification(args.payment_yoo_id, args.user_id, args.period, amount)
+    async with ClientSession() as session:
+        for _ in range(args.repeat):
+            async with session.post(args.url, json=body) as response:
+                print(f"{response.status} {await response.text()}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())